@@ -0,0 +1,133 @@
+import fcntl
+import os
+import tempfile
+import threading
+
+
+class AdmissionError(Exception):
+
+    def __init__(self, message, status_code, retry_after):
+        super(AdmissionError, self).__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def usable_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class Admission(object):
+    """Decides how many conversions run at once and who may queue more work."""
+
+    def __init__(self, app=None):
+        self.slots = 1
+        self.memory_budget = None
+        self.job_memory = dict()
+        self.queue_limit = None
+        self.user_limit = None
+        self.session_limit = None
+        self.retry_after = 30
+        self.directory = None
+        self.held = dict()
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.slots = app.config.get('CONVERT_WORKERS') or \
+            max(1, int(usable_cores() * app.config.get('ADMISSION_JOBS_PER_CORE', 1)))
+        self.memory_budget = app.config.get('ADMISSION_MEMORY_BUDGET')
+        if self.memory_budget is None and physical_memory() is not None:
+            self.memory_budget = physical_memory() * 3 // 4
+        self.job_memory = app.config.get('ADMISSION_JOB_MEMORY') or dict()
+        self.queue_limit = app.config.get('JOB_QUEUE_LIMIT')
+        self.user_limit = app.config.get('ADMISSION_USER_JOBS')
+        self.session_limit = app.config.get('ADMISSION_SESSION_JOBS')
+        self.retry_after = app.config.get('ADMISSION_RETRY_AFTER', 30)
+        self.directory = app.config.get('ADMISSION_LOCK_DIRECTORY') or \
+            os.path.join(tempfile.gettempdir(), 'converter-admission')
+        os.makedirs(self.directory, exist_ok=True)
+
+    def slot_path(self, slot):
+        return os.path.join(self.directory, 'slot-{}'.format(slot))
+
+    def acquire(self, job_id, kind):
+        # Slots are lock files shared by every process on the machine. POSIX locks belong to the process that took
+        # them, so forked pool workers never inherit a slot and the slots of a crashed process are freed at once
+        with self.lock, open(os.path.join(self.directory, 'admission.lock'), 'a') as guard:
+            fcntl.lockf(guard, fcntl.LOCK_EX)
+            # Closing any descriptor of a file drops this process's lock on it, so held slots are never reopened
+            mine = {slot for _, slot, _ in self.held.values()}
+            running = [name for _, _, name in self.held.values()]
+            free = None
+            for slot in range(self.slots):
+                if slot in mine:
+                    continue
+                file = open(self.slot_path(slot), 'a+')
+                try:
+                    fcntl.lockf(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    file.seek(0)
+                    running.append(file.read().strip())
+                    file.close()
+                    continue
+                if free is None:
+                    free = file, slot
+                else:
+                    file.close()
+            if free is None or not self.fits(kind, running):
+                if free is not None:
+                    free[0].close()
+                return False
+            file, slot = free
+            file.truncate(0)
+            file.write(kind)
+            file.flush()
+            self.held[job_id] = file, slot, kind
+            return True
+
+    def release(self, job_id):
+        with self.lock:
+            entry = self.held.pop(job_id, None)
+        if entry is not None:
+            entry[0].close()
+
+    def fits(self, kind, running):
+        # running lists the kinds of the jobs converting on the whole machine.
+        # The first job always runs, otherwise a single oversized estimate would stall the queue forever
+        if not running:
+            return True
+        if len(running) >= self.slots:
+            return False
+        if self.memory_budget is None:
+            return True
+        return sum(self.job_memory.get(name, 0) for name in running) + \
+            self.job_memory.get(kind, 0) <= self.memory_budget
+
+    def client_limit(self, client):
+        if client.startswith('user:'):
+            return self.user_limit
+        return self.session_limit
+
+    def admit(self, depth, active, client, count=1):
+        # depth is the number of unfinished jobs on the whole site, active the ones of this client
+        limit = self.client_limit(client)
+        if limit is not None and count > limit:
+            # Waiting would never help, so this is not answered with 429
+            raise AdmissionError('At most {} conversions can be requested at once'.format(limit), 400, None)
+        if limit is not None and active + count > limit:
+            raise AdmissionError('You already have {} conversions in progress, the limit is {}'.format(active, limit),
+                                 429, self.retry_after)
+        if self.queue_limit is not None and depth + count > self.queue_limit:
+            raise AdmissionError('Sorry, the server is busy right now. Try again later', 503, self.retry_after)
@@ -1,8 +1,14 @@
+import atexit
+import fcntl
+import json
+import mimetypes
 import os
+import time
 import uuid
+from urllib.parse import quote
 
 from flask import Flask, render_template, redirect, flash, \
-    url_for, session, send_from_directory, request
+    url_for, session, send_file, request, jsonify, Response, abort, stream_with_context
 from flask_apscheduler import APScheduler
 from flask_login import LoginManager, login_user, \
     current_user, logout_user, login_required
@@ -10,37 +16,73 @@ from werkzeug.utils import secure_filename
 from flask_mail import Mail, Message
 from itsdangerous import URLSafeSerializer
 
-from archive_functions import ArchiveFuncs, ARCHIVE_SUPPORTED_FORMATS
-from convert_functions import PictureConverter, VideoConverter, AudioConverter, Converter
-from db import db, User, update_session
+from admission import AdmissionError
+from cache import RESULT_CACHE
+from archive_functions import ArchiveFuncs, ArchiveLimitError, ARCHIVE_LIMITS, ARCHIVE_SUPPORTED_FORMATS, \
+    ARCHIVE_CONTENT_FOLDER, ARCHIVE_EXTENSIONS
+from convert_functions import convert_files, IMAGE_LIMITS, PICTURE_SUPPORTED_FORMATS, AUDIO_SUPPORTED_FORMATS, \
+    VIDEO_SUPPORTED_FORMATS
+from db import db, User, Upload, update_session, to_db, ensure_schema, flush_activity, configure_sqlite, \
+    cached_user, forget_user, folder_size, discard_folder, TRASH_FOLDER
+from jobs import JobQueue, JOB_QUEUED, JOB_DONE, JOB_ERROR, job_kind, read_progress
 from file_upload import PictureForm, AudioForm, VideoForm, \
     ArchiveOpenForm, ArchiveConvertForm, ArchiveConvertForm2
 from loginform import LoginForm
+from mail_queue import MailQueue
+from profiling import PROFILER, phase
+from metrics import REGISTRY, UPLOAD_BYTES, DOWNLOAD_BYTES, ERRORS, JOB_QUEUE_DEPTH, FILES_DISK_USAGE
 from regform import RegForm
-from system_function import create_folder, get_file_type, create_files
+from storage import STORAGE
+from system_function import create_folder, create_upload_folder, get_file_type, create_files
+from upload_stream import StreamingRequest, UploadStream, upload_digest, upload_limit
 from config import Config
 
 
 MAX_CONTENT_LENGTH_FOR_AUTH = 400 * 1024 * 1024
 MAX_CONTENT_LENGTH_FOR_UNAUTH = 100 * 1024 * 1024
-PATH_TO_FILES = 'files'
+PATH_TO_FILES = STORAGE.root
+UPLOAD_READ_SIZE = 64 * 1024
+UPLOAD_TARGETS = {'picture': PICTURE_SUPPORTED_FORMATS, 'audio': AUDIO_SUPPORTED_FORMATS,
+                  'video': VIDEO_SUPPORTED_FORMATS, 'archive-open': None, 'archive-convert': None}
+disk_usage = {'measured': 0}
 
 app = Flask(__name__)
-create_files()
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///converter.db'
+app.request_class = StreamingRequest
+app.config['MAX_CONTENT_LENGTH_FOR_AUTH'] = MAX_CONTENT_LENGTH_FOR_AUTH
+app.config['MAX_CONTENT_LENGTH_FOR_UNAUTH'] = MAX_CONTENT_LENGTH_FOR_UNAUTH
 app.config.from_object(Config())
+app.config['USE_X_SENDFILE'] = app.config.get('DOWNLOAD_OFFLOAD') == 'x-sendfile'
+STORAGE.init_app(app)
+ARCHIVE_LIMITS.init_app(app)
+IMAGE_LIMITS.init_app(app)
+RESULT_CACHE.init_app(app)
+create_files()
+PROFILER.init_app(app)
 db.app = app
+configure_sqlite(app)
 db.init_app(app)
 db.create_all()
+ensure_schema()
 
 mail = Mail(app)
 
+outbox = MailQueue(app, mail)
+
+jobs = JobQueue(app)
+
 serializer = URLSafeSerializer(app.config['SECRET_KEY'])
 
 scheduler = APScheduler()
 scheduler.init_app(app)
 scheduler.start()
 
+
+@atexit.register
+def flush_pending_activity():
+    with app.app_context():
+        flush_activity()
+
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
@@ -52,6 +94,42 @@ def not_found(e):
     return render_template('not_found.html', title='Ooops...')
 
 
+@app.errorhandler(413)
+def too_large(e):
+    ERRORS.inc(type='RequestEntityTooLarge')
+    if request.path.startswith(('/api/', '/uploads')):
+        return jsonify(error='Max request size is {} MB'.format(upload_limit() // 1024 // 1024)), 413
+    if current_user.is_authenticated:
+        flash('Max file size is {} MB'.format(upload_limit() // 1024 // 1024), category='danger')
+    else:
+        flash('Max file size for unauthorized users is {} MB'.format(upload_limit() // 1024 // 1024),
+              category='danger')
+    return redirect(request.path)
+
+
+@app.errorhandler(AdmissionError)
+def over_capacity(e):
+    ERRORS.inc(type='AdmissionError')
+    if request.path.startswith(('/api/', '/uploads')):
+        response = jsonify(error=e.message)
+    else:
+        flash(e.message, category='danger')
+        response = app.make_response(render_template('main.html', title='Converter'))
+    response.status_code = e.status_code
+    if e.retry_after is not None:
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+@app.errorhandler(ArchiveLimitError)
+def archive_over_limit(e):
+    ERRORS.inc(type='ArchiveLimitError')
+    if request.path.startswith('/api/'):
+        return jsonify(error=str(e)), 413
+    flash(str(e), category='danger')
+    return redirect(url_for('index'))
+
+
 @app.before_request
 def before_request():
     check_operation_id()
@@ -59,7 +137,7 @@ def before_request():
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return cached_user(int(user_id), app.config['USER_CACHE_TTL'])
 
 
 @app.route('/')
@@ -96,6 +174,7 @@ def login():
 @app.route('/logout')
 @login_required
 def logout():
+    forget_user(current_user.id)
     logout_user()
     return redirect(url_for('index'))
 
@@ -123,7 +202,7 @@ def registration():
                       recipients=[email])
         link = url_for('confirmation', token=confirmation_token, _external=True)
         msg.body = 'Click on this link: {}'.format(link)
-        mail.send(msg)
+        outbox.send(msg)
         flash('Please, confirm your email.', category='primary')
         return redirect(url_for('login'))
     for errors in form.errors.values():
@@ -152,27 +231,15 @@ def open_archive():
     if form.validate_on_submit():
         check_operation_id()
         operation_id = session.get('user_operation_id')
-        path_to_folder = create_folder(operation_id)
-        content_res = check_content_length(request.headers.get('Content-Length'))
-        if isinstance(content_res, tuple):
-            flash('Sorry, an unknown error occurred. Try again later', category='danger')
-            return redirect(url_for('index'))
-        elif isinstance(content_res, str):
-            return redirect(url_for('open_archive'))
+        path_to_folder = create_upload_folder(operation_id)
         filename = save_file(form.file.data.filename, path_to_folder, form.file.data)
         if filename is None:
             return redirect(url_for('index'))
-        arc = ArchiveFuncs(path_to_folder, filename)
-        result = arc.extract_archive()
-        if isinstance(result, tuple):
-            flash('Sorry, an unknown error occurred', category='danger')
-            return redirect(url_for('index'))
-        files, filename = arc.all_files()
-        return render_template('open-arc.html', files=files.get('files'), filename=filename, title='Archive Open')
+        return render_archive('archive-open', path_to_folder, filename)
     for errors in form.errors.values():
         for error in errors:
             flash(error, category='danger')
-    return render_template('open-arc.html', form=form, title='Archive Open')
+    return render_template('open-arc.html', form=form, upload_target='archive-open', title='Archive Open')
 
 
 @app.route('/archive-convert', methods=['GET', 'POST'])
@@ -183,71 +250,141 @@ def convert_archive():
     if form.validate_on_submit():
         check_operation_id()
         operation_id = session.get('user_operation_id')
-        path_to_folder = create_folder(operation_id)
-        content_res = check_content_length(request.headers.get('Content-Length'))
-        if isinstance(content_res, tuple):
-            flash('Sorry, an unknown error occurred. Try again later', category='danger')
-            return redirect(url_for('index'))
-        elif isinstance(content_res, str):
-            return redirect(url_for('convert_archive'))
+        path_to_folder = create_upload_folder(operation_id)
         filename = save_file(form.file.data.filename, path_to_folder, form.file.data)
         if filename is None:
             return redirect(url_for('index'))
-        arc = ArchiveFuncs(path_to_folder, filename)
-        result = arc.extract_archive()
-        if isinstance(result, tuple):
-            flash('Sorry, an unknown error occurred. Please try again later.', category='danger')
-            return redirect(url_for('index'))
-        files, archive_filename = arc.all_files()
-        return render_template('convert-arc.html', files=files.get('files'), filename=archive_filename,
-                               get_file_type=get_file_type, arc_formats=ARCHIVE_SUPPORTED_FORMATS, form2=form2,
-                               title='Archive Convert')
+        return render_archive('archive-convert', path_to_folder, filename)
     if form2.validate_on_submit():
         dict_of_files = request.form.to_dict()
-        files = list(filter(lambda x: os.path.exists(x), dict_of_files.keys()))
-        for el in files:
-            el_of_paths = el.split('/')
-            path = '/'.join(el_of_paths[:-1])
-            file = el_of_paths[-1]
-            converter = Converter(path, file, dict_of_files[el])
-            result = converter.convert()
-            if bool(result):
-                flash('Sorry, {} error occurred, but the archive can be successfully created.'
-                      ' Please note that there may be broken content'.format(len(result)), category='warning')
-            archive_filename = uuid.uuid4().hex if archive_filename is None else archive_filename
-            arc_converter = ArchiveFuncs(os.path.join(PATH_TO_FILES, session.get('user_operation_id')),
-                                         archive_filename)
-            path_new = arc_converter.make_archive(dict_of_files['arc'])
-            if isinstance(path_new, str):
-                el_path_new = path_new.split('/')
-                file_new = el_path_new[-1]
-                return render_template('result.html', path=path_new, new_filename=file_new, title='Download')
-            else:
-                flash('Sorry, an unknown error occurred', category='danger')
+        path_to_folder = archive_folder()
+        if not (app.config.get('ARCHIVE_STREAMING') and dict_of_files.get('arc') in ARCHIVE_EXTENSIONS):
+            return convert_archive_pipeline(path_to_folder, dict_of_files)
+        with phase('archive'):
+            extracted = session.get('archive_filename') is not None and not isinstance(archive_result(
+                ArchiveFuncs(path_to_folder, session.get('archive_filename')).extract_archive()), tuple)
+        if not extracted:
+            flash('Sorry, an unknown error occurred. Please try again later.', category='danger')
             return redirect(url_for('index'))
+        members = list()
+        for el, new_format in dict_of_files.items():
+            if not in_folder(el, path_to_folder) or not os.path.exists(el) or new_format == 'not_convert':
+                continue
+            path, file = os.path.split(el)
+            members.append((path, file, new_format))
+        with archive_workers(path_to_folder, dict_of_files['arc']) as workers, phase('convert'):
+            errors = convert_files(members, workers)
+        if errors:
+            flash('Sorry, {} error occurred, but the archive can be successfully created.'
+                  ' Please note that there may be broken content'.format(sum(map(len, errors.values()))),
+                  category='warning')
         archive_filename = uuid.uuid4().hex if archive_filename is None else archive_filename
-        arc_converter = ArchiveFuncs(os.path.join(PATH_TO_FILES, session.get('user_operation_id')),
-                                     archive_filename)
-        path_new = arc_converter.make_archive(dict_of_files['arc'])
-        if isinstance(path_new, str):
-            el_path_new = path_new.split('/')
-            file_new = el_path_new[-1]
-            return render_template('result.html', path=path_new, new_filename=file_new, title='Download')
+        file_new = '{}{}'.format(archive_filename, ARCHIVE_EXTENSIONS[dict_of_files['arc']])
+        return render_template('result.html', new_filename=file_new, title='Download',
+                               download_url=url_for('stream_archive', arc_format=dict_of_files['arc'],
+                                                    filename=file_new))
     for errors in form.errors.values():
         for error in errors:
             flash(error, category='danger')
-    return render_template('convert-arc.html', form=form, title='Archive Convert')
+    return render_template('convert-arc.html', form=form, upload_target='archive-convert', title='Archive Convert')
+
+
+def convert_archive_pipeline(path_to_folder, dict_of_files):
+    if session.get('archive_filename') is None:
+        flash('Sorry, an unknown error occurred. Please try again later.', category='danger')
+        return redirect(url_for('index'))
+    content = os.path.join(path_to_folder, ARCHIVE_CONTENT_FOLDER)
+    formats = {os.path.relpath(el, content): new_format for el, new_format in dict_of_files.items()
+               if in_folder(el, content) and new_format != 'not_convert'}
+    arc = ArchiveFuncs(path_to_folder, session.get('archive_filename'))
+    with archive_workers(path_to_folder, dict_of_files.get('arc')) as workers, phase('archive'):
+        result = archive_result(arc.convert_archive(uuid.uuid4().hex, dict_of_files.get('arc'), formats, workers))
+    if not isinstance(result, dict):
+        flash('Sorry, an unknown error occurred', category='danger')
+        return redirect(url_for('index'))
+    if result['errors']:
+        flash('Sorry, {} error occurred, but the archive can be successfully created.'
+              ' Please note that there may be broken content'.format(sum(map(len, result['errors'].values()))),
+              category='warning')
+    return render_template('result.html', path=result['path'], new_filename=os.path.basename(result['path']),
+                           title='Download')
+
+
+def archive_workers(path_to_folder, arc_format):
+    # The archive's own worker pool only gets the conversion slots that are free on the machine
+    return jobs.reserve('archive', path_to_folder, session.get('archive_filename'), arc_format or '',
+                        session.get('user_operation_id'), job_client(),
+                        app.config.get('ARCHIVE_CONVERT_WORKERS') or jobs.admission.slots)
+
+
+def archive_result(result):
+    # Limit errors carry a message meant for the user, archive_over_limit answers them
+    if isinstance(result, tuple) and isinstance(result[1], ArchiveLimitError):
+        raise result[1]
+    return result
+
+
+def remember_archive(path_to_folder, filename):
+    session['archive_folder'] = os.path.basename(path_to_folder)
+    session['archive_filename'] = filename
+
+
+def archive_folder():
+    # The folder name comes from the session, only its last component is trusted
+    return os.path.join(STORAGE.folder(session.get('user_operation_id')),
+                        os.path.basename(session.get('archive_folder') or ''))
+
+
+def render_archive(target, path_to_folder, filename):
+    arc = ArchiveFuncs(path_to_folder, filename)
+    remember_archive(path_to_folder, filename)
+    with phase('archive'):
+        result = archive_result(arc.list_files())
+    if result[0] == 'error':
+        flash('Sorry, an unknown error occurred. Please try again later.', category='danger')
+        return redirect(url_for('index'))
+    files, archive_filename = result
+    if target == 'archive-open':
+        return render_template('open-arc.html', files=files.get('files'), filename=archive_filename,
+                               title='Archive Open')
+    return render_template('convert-arc.html', files=files.get('files'), filename=archive_filename,
+                           get_file_type=get_file_type, arc_formats=ARCHIVE_SUPPORTED_FORMATS,
+                           form2=ArchiveConvertForm2(), title='Archive Convert')
+
+
+@app.route('/archive-stream/<arc_format>/<filename>')
+def stream_archive(arc_format, filename):
+    path_to_folder = archive_folder()
+    if arc_format not in ARCHIVE_EXTENSIONS or not os.path.isdir(os.path.join(path_to_folder, ARCHIVE_CONTENT_FOLDER)):
+        return redirect(url_for('index'))
+    filename = secure_filename(filename)
+    arc = ArchiveFuncs(path_to_folder, filename)
+    return Response(arc.stream_archive(arc_format), mimetype='application/octet-stream',
+                    headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
+
+
+@app.route('/archive-extract/<path:file_path>')
+def extract_member(file_path):
+    path_to_folder = archive_folder()
+    archive_filename = session.get('archive_filename')
+    if archive_filename is None or not in_folder(file_path, path_to_folder):
+        return redirect(url_for('index'))
+    if not STORAGE.localize(file_path):
+        arc = ArchiveFuncs(path_to_folder, archive_filename)
+        name = os.path.relpath(file_path, os.path.join(path_to_folder, ARCHIVE_CONTENT_FOLDER))
+        if isinstance(archive_result(arc.extract_member(name)), tuple):
+            flash('Sorry, an unknown error occurred while extracting the file', category='danger')
+            return redirect(url_for('index'))
+    return redirect(url_for('download', file_path=file_path))
 
 
 # noinspection PyBroadException
 @app.route('/download/<path:file_path>', methods=['GET', 'POST'])
 def download(file_path):
     try:
-        if PATH_TO_FILES in file_path and session.get('user_operation_id') in file_path:
-            splited = file_path.split('/')
-            filename = splited[-1]
-            path = '/'.join(splited[:-1])
-            return send_from_directory(path, filename, as_attachment=True)
+        path_to_folder = STORAGE.folder(session.get('user_operation_id'))
+        if in_folder(file_path, path_to_folder) and STORAGE.localize(file_path):
+            return send_operation_file(file_path)
         return redirect(url_for('index'))
     except Exception:
         flash('Sorry, an unknown error occurred while getting the link to download the file.'
@@ -261,27 +398,19 @@ def convert_picture():
     if form.validate_on_submit():
         check_operation_id()
         operation_id = session.get('user_operation_id')
-        path_to_folder = create_folder(operation_id)
-        content_res = check_content_length(request.headers.get('Content-Length'))
-        if isinstance(content_res, tuple):
-            flash('Sorry, an unknown error occurred. Try again later', category='danger')
-            return redirect(url_for('index'))
-        elif isinstance(content_res, str):
-            return redirect(url_for('convert_picture'))
+        jobs.admit(job_client())
+        path_to_folder = create_upload_folder(operation_id)
         filename = save_file(form.file.data.filename, path_to_folder, form.file.data)
         if filename is None:
             return redirect(url_for('index'))
-        converter = PictureConverter(path_to_folder, filename)
-        res = converter.convert(form.file_format.data)
-        path = res['new_file_path'] if isinstance(error_converting(res), dict) else 'error'
-        if path == 'error':
-            return redirect(url_for('index'))
-        new_file = path.split('/')[-1]
-        return render_template('result.html', path=path, new_filename=new_file, title='Download')
+        with phase('convert'):
+            job_id = jobs.enqueue('picture', path_to_folder, filename, form.file_format.data, operation_id,
+                                  upload_digest(form.file.data), job_client())
+        return redirect(url_for('job_status', job_id=job_id))
     for errors in form.errors.values():
         for error in errors:
             flash(error, category='danger')
-    return render_template('convert.html', form=form, title='Convert Image')
+    return render_template('convert.html', form=form, upload_target='picture', title='Convert Image')
 
 
 @app.route('/audio-convert', methods=['GET', 'POST'])
@@ -290,27 +419,19 @@ def convert_audio():
     if form.validate_on_submit():
         check_operation_id()
         operation_id = session.get('user_operation_id')
-        path_to_folder = create_folder(operation_id)
-        content_res = check_content_length(request.headers.get('Content-Length'))
-        if isinstance(content_res, tuple):
-            flash('Sorry, an unknown error occurred. Try again later', category='danger')
-            return redirect(url_for('index'))
-        elif isinstance(content_res, str):
-            return redirect(url_for('convert_audio'))
+        jobs.admit(job_client())
+        path_to_folder = create_upload_folder(operation_id)
         filename = save_file(form.file.data.filename, path_to_folder, form.file.data)
         if filename is None:
             return redirect(url_for('index'))
-        converter = AudioConverter(path_to_folder, filename)
-        res = converter.convert(form.file_format.data)
-        path = res['new_file_path'] if isinstance(error_converting(res), dict) else 'error'
-        if path == 'error':
-            return redirect(url_for('index'))
-        new_file = path.split('/')[-1]
-        return render_template('result.html', path=path, new_filename=new_file, title='Download')
+        with phase('convert'):
+            job_id = jobs.enqueue('audio', path_to_folder, filename, form.file_format.data, operation_id,
+                                  upload_digest(form.file.data), job_client())
+        return redirect(url_for('job_status', job_id=job_id))
     for errors in form.errors.values():
         for error in errors:
             flash(error, category='danger')
-    return render_template('convert.html', form=form, title='Convert Audio')
+    return render_template('convert.html', form=form, upload_target='audio', title='Convert Audio')
 
 
 @app.route('/video-convert', methods=['GET', 'POST'])
@@ -319,27 +440,353 @@ def convert_video():
     if form.validate_on_submit():
         check_operation_id()
         operation_id = session.get('user_operation_id')
-        path_to_folder = create_folder(operation_id)
-        content_res = check_content_length(request.headers.get('Content-Length'))
-        if isinstance(content_res, tuple):
-            flash('Sorry, an unknown error occurred. Try again later', category='danger')
-            return redirect(url_for('index'))
-        elif isinstance(content_res, str):
-            return redirect(url_for('convert_video'))
+        jobs.admit(job_client())
+        path_to_folder = create_upload_folder(operation_id)
         filename = save_file(form.file.data.filename, path_to_folder, form.file.data)
         if filename is None:
             return redirect(url_for('index'))
-        converter = VideoConverter(path_to_folder, filename)
-        res = converter.convert(form.file_format.data)
-        path = res['new_file_path'] if isinstance(error_converting(res), dict) else 'error'
-        if path == 'error':
-            return redirect(url_for('index'))
-        new_file = path.split('/')[-1]
-        return render_template('result.html', path=path, new_filename=new_file, title='Download')
+        with phase('convert'):
+            job_id = jobs.enqueue('video', path_to_folder, filename, form.file_format.data, operation_id,
+                                  upload_digest(form.file.data), job_client())
+        return redirect(url_for('job_status', job_id=job_id))
     for errors in form.errors.values():
         for error in errors:
             flash(error, category='danger')
-    return render_template('convert.html', form=form, title='Convert video')
+    return render_template('convert.html', form=form, upload_target='video', title='Convert video')
+
+
+@app.route('/api/v1/batches', methods=['POST'])
+def api_create_batch():
+    files = request.files.getlist('files')
+    archive = request.files.get('archive')
+    if not files and archive is None:
+        return jsonify(error='Send one or more files or an archive'), 400
+    client = job_client()
+    # The quota is checked before anything is written; an archive's member count is only known once it is read
+    jobs.admit(client, len(files) or 1)
+    batch_id = uuid.uuid4().hex
+    try:
+        response = create_batch(batch_id, create_folder(batch_id), files, archive, client)
+    except Exception:
+        discard_folder(batch_id)
+        raise
+    if isinstance(response, tuple):
+        # Refused batches leave nothing behind
+        discard_folder(batch_id)
+    return response
+
+
+def create_batch(batch_id, path_to_batch, files, archive, client):
+    default_format = request.form.get('format')
+    if archive is not None:
+        try:
+            formats = json.loads(request.form.get('formats') or '{}')
+        except ValueError:
+            return jsonify(error='formats must be a JSON object mapping archive members to formats'), 400
+        sources = batch_archive_members(path_to_batch, archive)
+        if sources is None:
+            return jsonify(error='Could not read the archive'), 400
+        # Members without an explicit target only get the default one when it applies to their type
+        items = [(source, name, formats.get(name) or default_format) for source, name in sources
+                 if name in formats or target_formats(name, default_format)]
+    else:
+        formats = request.form.getlist('formats')
+        if formats and len(formats) != len(files):
+            return jsonify(error='Send one format per file or a single default format'), 400
+        items = [(file_data, file_data.filename, formats[index] if formats else default_format)
+                 for index, file_data in enumerate(files)]
+    targets = [target_formats(name, new_format) for _, name, new_format in items]
+    invalid = [name for (_, name, _), new_formats in zip(items, targets) if new_formats is None]
+    if invalid or not items:
+        return jsonify(error='No supported target format', items=invalid), 400
+    count = sum(map(len, targets))
+    if count > app.config.get('API_MAX_BATCH_ITEMS', 1000):
+        return jsonify(error='At most {} items per batch'.format(app.config.get('API_MAX_BATCH_ITEMS'))), 400
+    jobs.admit(client, count)
+    jobs_to_enqueue = list()
+    for index, ((source, name, _), new_formats) in enumerate(zip(items, targets)):
+        path = os.path.join(path_to_batch, str(index))
+        if isinstance(source, str):
+            destination = os.path.join(path, name)
+            os.makedirs(os.path.dirname(destination))
+            os.replace(source, destination)
+            path, filename, digest = os.path.dirname(destination), os.path.basename(destination), None
+        else:
+            os.mkdir(path)
+            filename = save_file(name, path, source)
+            if filename is None:
+                return jsonify(error='Could not save {}'.format(name)), 500
+            digest = upload_digest(source)
+        # Every format of a file becomes its own item; the queue converts a picture's formats from one decode
+        jobs_to_enqueue.extend((job_kind(filename), path, filename, new_format, digest) for new_format in new_formats)
+    with phase('convert'):
+        jobs.enqueue_many(jobs_to_enqueue, batch_id, client)
+    response = jsonify(batch_report(batch_id))
+    response.status_code = 202
+    response.headers['Location'] = url_for('api_batch', batch_id=batch_id)
+    return response
+
+
+@app.route('/api/v1/batches/<batch_id>')
+def api_batch(batch_id):
+    if not jobs.batch(batch_id):
+        return jsonify(error='not found'), 404
+    return jsonify(batch_report(batch_id))
+
+
+@app.route('/api/v1/batches/<batch_id>/items/<job_id>/download')
+def api_download(batch_id, job_id):
+    job = jobs.get(job_id, batch_id)
+    if job is None or job.status != JOB_DONE or not in_folder(job.result, STORAGE.folder(batch_id)) \
+            or not STORAGE.localize(job.result):
+        return jsonify(error='not found'), 404
+    return send_operation_file(job.result)
+
+
+def target_formats(name, value):
+    # Pictures may be asked for in several formats at once, as a comma separated list in any case
+    if not isinstance(value, str):
+        return None
+    new_formats = list(dict.fromkeys(new_format.strip().upper() for new_format in value.split(',')))
+    supported = get_file_type(name) or ()
+    if not all(new_format in supported for new_format in new_formats):
+        return None
+    if len(new_formats) > 1 and supported is not PICTURE_SUPPORTED_FORMATS:
+        return None
+    return new_formats
+
+
+def batch_archive_members(path_to_batch, archive):
+    filename = save_file(archive.filename, path_to_batch, archive)
+    if filename is None:
+        return None
+    if isinstance(archive_result(ArchiveFuncs(path_to_batch, filename).extract_archive()), tuple):
+        return None
+    content = os.path.join(path_to_batch, ARCHIVE_CONTENT_FOLDER)
+    return [(os.path.join(root, file), os.path.relpath(os.path.join(root, file), content))
+            for root, dirs, files in os.walk(content) for file in files]
+
+
+def batch_report(batch_id):
+    path_to_batch = STORAGE.folder(batch_id)
+    items = list()
+    for job in jobs.batch(batch_id):
+        # Every item lives in its own numbered folder, which also keeps the upload order
+        index = os.path.relpath(job.path, path_to_batch).split(os.sep)[0]
+        item = {'id': job.id, 'index': int(index), 'status': job.status, 'format': job.new_format,
+                'name': os.path.relpath(os.path.join(job.path, job.filename), os.path.join(path_to_batch, index))}
+        if job.status == JOB_DONE:
+            item['download_url'] = url_for('api_download', batch_id=batch_id, job_id=job.id, _external=True)
+        elif job.status == JOB_ERROR:
+            item['error'] = job.error
+        items.append(item)
+    items.sort(key=lambda item: item['index'])
+    return {'id': batch_id, 'status': JOB_QUEUED if any(item['status'] == JOB_QUEUED for item in items) else JOB_DONE,
+            'items': items, 'status_url': url_for('api_batch', batch_id=batch_id, _external=True)}
+
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(data.get('filename') or '')
+    size = data.get('size')
+    if not filename or not isinstance(size, int) or size <= 0:
+        return jsonify(error='filename and size are required'), 400
+    if size > upload_limit():
+        return jsonify(error='Max file size is {} MB'.format(upload_limit() // 1024 // 1024)), 413
+    check_operation_id()
+    operation_id = session.get('user_operation_id')
+    create_folder(operation_id)
+    upload = Upload(id=uuid.uuid4().hex, user_operation_id=operation_id, filename=filename, size=size)
+    update_session(upload)
+    open(upload_part(upload), 'wb').close()
+    response = upload_state(upload, 0)
+    response.status_code = 201
+    response.headers['Location'] = url_for('upload_chunk', upload_id=upload.id)
+    return response
+
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'HEAD', 'PATCH'])
+def upload_chunk(upload_id):
+    upload = Upload.query.get(upload_id)
+    if upload is None or upload.user_operation_id != session.get('user_operation_id'):
+        return jsonify(error='not found'), 404
+    part = upload_part(upload)
+    if not os.path.exists(part):
+        # The operation folder was removed by the sweeper
+        return jsonify(error='upload expired'), 410
+    if request.method != 'PATCH':
+        return upload_state(upload, os.path.getsize(part))
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        return jsonify(error='Upload-Offset header is required'), 400
+    with open(part, 'r+b') as file:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            response = upload_state(upload, os.fstat(file.fileno()).st_size)
+            response.status_code = 409
+            return response
+        current = os.fstat(file.fileno()).st_size
+        if offset != current:
+            response = upload_state(upload, current)
+            response.status_code = 409
+            return response
+        file.seek(current)
+        # Whatever arrives before a dropped connection stays on disk, the client resumes from there
+        for chunk in iter(lambda: request.stream.read(UPLOAD_READ_SIZE), b''):
+            if current + len(chunk) > upload.size:
+                file.truncate(offset)
+                return jsonify(error='chunk goes past the declared size'), 400
+            file.write(chunk)
+            current += len(chunk)
+    to_db(upload.user_operation_id)
+    response = upload_state(upload, current)
+    response.status_code = 200
+    return response
+
+
+@app.route('/uploads/<upload_id>/finish', methods=['POST'])
+def finish_upload(upload_id):
+    upload = Upload.query.get(upload_id)
+    if upload is None or upload.user_operation_id != session.get('user_operation_id'):
+        return jsonify(error='not found'), 404
+    data = request.get_json(silent=True) or {}
+    target, new_format = data.get('target'), data.get('format')
+    if target not in UPLOAD_TARGETS or UPLOAD_TARGETS[target] is not None and new_format not in UPLOAD_TARGETS[target]:
+        return jsonify(error='unsupported target or format'), 400
+    part = upload_part(upload)
+    if not os.path.exists(part) or os.path.getsize(part) != upload.size:
+        return jsonify(error='upload is not complete'), 409
+    path_to_folder = create_upload_folder(upload.user_operation_id)
+    filename = upload.filename
+    os.replace(part, os.path.join(path_to_folder, filename))
+    STORAGE.publish(os.path.join(path_to_folder, filename))
+    if UPLOAD_TARGETS[target] is None:
+        remember_archive(path_to_folder, filename)
+        redirect_url = url_for('uploaded_archive', target=target)
+    else:
+        try:
+            with phase('convert'):
+                job_id = jobs.enqueue(target, path_to_folder, filename, new_format, upload.user_operation_id,
+                                      client=job_client())
+        except AdmissionError:
+            # Keep the upload so the client can finish it again later
+            os.replace(os.path.join(path_to_folder, filename), part)
+            os.rmdir(path_to_folder)
+            raise
+        redirect_url = url_for('job_status', job_id=job_id)
+    UPLOAD_BYTES.inc(upload.size)
+    db.session.delete(upload)
+    db.session.commit()
+    return jsonify(redirect=redirect_url)
+
+
+@app.route('/uploads/archive/<target>')
+def uploaded_archive(target):
+    filename = session.get('archive_filename')
+    if target not in ('archive-open', 'archive-convert') or filename is None:
+        return redirect(url_for('index'))
+    return render_archive(target, archive_folder(), filename)
+
+
+def upload_part(upload):
+    return os.path.join(STORAGE.folder(upload.user_operation_id), '{}.part'.format(upload.id))
+
+
+def upload_state(upload, offset):
+    response = jsonify(id=upload.id, offset=offset, size=upload.size,
+                       url=url_for('upload_chunk', upload_id=upload.id),
+                       finish_url=url_for('finish_upload', upload_id=upload.id))
+    response.headers['Upload-Offset'] = str(offset)
+    response.headers['Upload-Length'] = str(upload.size)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.get(job_id, session.get('user_operation_id'))
+    if job is None:
+        return redirect(url_for('index'))
+    if job.status == JOB_DONE:
+        new_file = job.result.split('/')[-1]
+        return render_template('result.html', path=job.result, new_filename=new_file, title='Download')
+    if job.status == JOB_ERROR:
+        if job.error and job.error.startswith('ImageLimitError: '):
+            flash(job.error.partition(': ')[2], category='danger')
+        else:
+            error_converting(None)
+        return redirect(url_for('index'))
+    return render_template('processing.html', status_url=url_for('job_status_json', job_id=job_id),
+                           events_url=url_for('job_events', job_id=job_id), title='Processing')
+
+
+@app.route('/jobs/<job_id>/status')
+def job_status_json(job_id):
+    job = jobs.get(job_id, session.get('user_operation_id'))
+    if job is None:
+        return jsonify(error='not found'), 404
+    queued = job.status == JOB_QUEUED
+    return jsonify(id=job.id, status=job.status, result_url=url_for('job_status', job_id=job.id), method=job.method,
+                   progress=read_progress(job) if queued else None, position=jobs.position(job) if queued else None)
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    operation_id = session.get('user_operation_id')
+    if jobs.get(job_id, operation_id) is None:
+        return jsonify(error='not found'), 404
+    interval = app.config.get('PROGRESS_POLL_INTERVAL', 1)
+
+    def events():
+        last = None
+        # Streams are short so that a sync worker is only held for a moment; between two streams the browser
+        # waits PROGRESS_STREAM_RETRY seconds and the worker serves other requests
+        deadline = time.monotonic() + app.config.get('PROGRESS_STREAM_TIMEOUT', 15)
+        yield 'retry: {}\n\n'.format(int(app.config.get('PROGRESS_STREAM_RETRY', 3) * 1000))
+        while time.monotonic() < deadline:
+            # Ends the read transaction and expires the cached row, so every round sees the worker's update
+            db.session.rollback()
+            job = jobs.get(job_id, operation_id)
+            if job is None or job.status != JOB_QUEUED:
+                yield sse_event('done', {'status': job.status if job is not None else JOB_ERROR,
+                                         'result_url': url_for('job_status', job_id=job_id)})
+                return
+            progress = read_progress(job)
+            if progress is not None and progress != last:
+                yield sse_event('progress', progress)
+                last = progress
+            time.sleep(interval)
+        # The browser's EventSource reconnects by itself once the stream is closed
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def sse_event(name, data):
+    return 'event: {}\ndata: {}\n\n'.format(name, json.dumps(data))
+
+
+@app.route('/metrics')
+def metrics():
+    if not app.config.get('METRICS_ENABLED'):
+        abort(404)
+    JOB_QUEUE_DEPTH.set(jobs.depth())
+    # Walking the files folder is expensive, scrapes within the TTL reuse the last measurement
+    if time.monotonic() - disk_usage['measured'] > app.config.get('METRICS_DISK_USAGE_TTL', 60):
+        FILES_DISK_USAGE.set(folder_size(PATH_TO_FILES, exclude=(os.path.basename(TRASH_FOLDER),)))
+        disk_usage['measured'] = time.monotonic()
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+def job_client():
+    if current_user.is_authenticated:
+        return 'user:{}'.format(current_user.id)
+    return 'session:{}'.format(session.get('user_operation_id'))
 
 
 def check_operation_id():
@@ -347,6 +794,31 @@ def check_operation_id():
         else session.get('user_operation_id')
 
 
+def send_operation_file(file_path):
+    # Inode, size and mtime identify the exact file, so the validator is strong and safe for Range requests
+    stat = os.stat(file_path)
+    etag = '{:x}-{:x}-{:x}'.format(stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    if app.config.get('DOWNLOAD_OFFLOAD') == 'x-accel':
+        response = Response(mimetype=mimetypes.guess_type(file_path)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = '{}{}'.format(app.config['DOWNLOAD_ACCEL_PREFIX'],
+                                                             quote(os.path.relpath(file_path, PATH_TO_FILES)))
+        response.headers.set('Content-Disposition', 'attachment', filename=os.path.basename(file_path))
+        response.set_etag(etag)
+        response.last_modified = stat.st_mtime
+        response = response.make_conditional(request)
+        if response.status_code == 200:
+            DOWNLOAD_BYTES.inc(stat.st_size)
+        return response
+    response = send_file(file_path, as_attachment=True, conditional=True, etag=etag)
+    if response.status_code in (200, 206):
+        DOWNLOAD_BYTES.inc(response.content_length or 0)
+    return response
+
+
+def in_folder(path, folder):
+    return os.path.abspath(path).startswith(os.path.abspath(folder) + os.sep)
+
+
 def error_converting(result):
     if not isinstance(result, dict):
         flash('An error occurred while converting the file.'
@@ -360,27 +832,17 @@ def error_converting(result):
 def save_file(filename, path, file_data):
     try:
         filename = secure_filename(filename)
-        file_data.save(os.path.join(path, filename))
+        with phase('save'):
+            if isinstance(file_data.stream, UploadStream):
+                file_data.stream.commit(os.path.join(path, filename))
+            else:
+                file_data.save(os.path.join(path, filename))
+            STORAGE.publish(os.path.join(path, filename))
+        UPLOAD_BYTES.inc(os.path.getsize(os.path.join(path, filename)))
         return filename
     except Exception:
         flash('Sorry, an unknown error occurred. Please try again later', category='danger')
 
 
-def check_content_length(length):
-    try:
-        length = int(length)
-        if current_user.is_authenticated:
-            if length > MAX_CONTENT_LENGTH_FOR_AUTH:
-                flash('Max file size is 400 MB', category='danger')
-                return 'limit'
-        else:
-            if length > MAX_CONTENT_LENGTH_FOR_UNAUTH:
-                flash('Max file size for unauthorized users is 100 MB', category='danger')
-                return 'limit'
-        return None
-    except Exception as e:
-        return 'error', e
-
-
 if __name__ == '__main__':
     app.run(port=8080, host='127.0.0.1')
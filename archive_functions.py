@@ -1,13 +1,317 @@
+import collections
+import copy
 import os
+import queue
 import shutil
+import struct
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
 
+from convert_functions import convert_member, conversion_errors
+from storage import STORAGE
+
 ARCHIVE_CONTENT_FOLDER = 'content'
 ARCHIVE_SUPPORTED_FORMATS = [x[0] for x in shutil.get_unpack_formats()]
 SUFFIXES_TO_FORMAT = {x[0]: x[1] for x in shutil.get_unpack_formats()}
 FORMAT_TO_SUFFIXES = {s: x for x, y in SUFFIXES_TO_FORMAT.items() for s in y}
 SUPPORTED_SUFFIXES = list(FORMAT_TO_SUFFIXES.keys())
 SUPPORTED_ARCHIVE_FORMATS_FOR_FORMS = {x: x.split('.')[-1] for x in SUPPORTED_SUFFIXES}
+TAR_STREAM_MODES = {'tar': 'w|', 'gztar': 'w|gz', 'bztar': 'w|bz2', 'xztar': 'w|xz'}
+ARCHIVE_EXTENSIONS = {'zip': '.zip', 'tar': '.tar', 'gztar': '.tar.gz', 'bztar': '.tar.bz2', 'xztar': '.tar.xz'}
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_QUEUE_SIZE = 16
+PIPELINE_FOLDER = 'pipeline'
+PIPELINE_MEMBERS_PER_WORKER = 2
+ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+ZIP_LOCAL_SIGNATURE = b'PK\x03\x04'
+ZIP_DATA_DESCRIPTOR_FLAG = 0x08
+RATIO_CHECK_MIN_SIZE = 16 * 1024 * 1024
+
+ArchiveMember = collections.namedtuple('ArchiveMember', 'name is_dir size mtime info')
+
+
+class StreamClosed(Exception):
+    pass
+
+
+class ArchiveLimitError(Exception):
+    pass
+
+
+class ArchiveLimits(object):
+    """Bounds on what reading an uploaded archive may cost; crossing one raises ArchiveLimitError."""
+
+    def __init__(self, app=None):
+        self.max_members = None
+        self.max_size = None
+        self.max_ratio = None
+        self.max_depth = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_members = app.config.get('ARCHIVE_MAX_MEMBERS')
+        self.max_size = app.config.get('ARCHIVE_MAX_SIZE')
+        self.max_ratio = app.config.get('ARCHIVE_MAX_RATIO')
+        self.max_depth = app.config.get('ARCHIVE_MAX_DEPTH')
+
+    def budget(self, archive_size):
+        return ArchiveBudget(self, archive_size)
+
+
+class ArchiveBudget(object):
+
+    def __init__(self, limits, archive_size):
+        self.limits = limits
+        self.archive_size = max(archive_size, 1)
+        self.members = 0
+        self.declared = 0
+        self.written = 0
+
+    def admit(self, member):
+        # Called before a member is read: zip readers stop at the declared size and a tar reader has to
+        # decompress exactly the declared size to skip a member, so the headers bound the real work
+        self.members += 1
+        if self.limits.max_members is not None and self.members > self.limits.max_members:
+            raise ArchiveLimitError('The archive has more than {} files'.format(self.limits.max_members))
+        if self.limits.max_depth is not None and \
+                len(os.path.normpath(member.name).split(os.sep)) > self.limits.max_depth:
+            raise ArchiveLimitError('The archive nests folders more than {} levels deep'.format(self.limits.max_depth))
+        self.declared += member.size
+        self.check(self.declared)
+
+    def check(self, size):
+        if self.limits.max_size is not None and size > self.limits.max_size:
+            raise ArchiveLimitError('The archive unpacks to more than {} MB'.format(
+                self.limits.max_size // 1024 // 1024))
+        if self.limits.max_ratio is not None and size > RATIO_CHECK_MIN_SIZE and \
+                size > self.archive_size * self.limits.max_ratio:
+            raise ArchiveLimitError('The archive is compressed more than {} times'.format(self.limits.max_ratio))
+
+    def copy(self, src, dst):
+        while True:
+            chunk = src.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            self.written += len(chunk)
+            self.check(self.written)
+            dst.write(chunk)
+
+
+ARCHIVE_LIMITS = ArchiveLimits()
+
+
+class QueueWriter(object):
+    """Write-only file object handing fixed-size chunks to a bounded queue read by the response generator."""
+
+    def __init__(self, chunks, stopped):
+        self.chunks = chunks
+        self.stopped = stopped
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= STREAM_CHUNK_SIZE:
+            self.put(bytes(self.buffer[:STREAM_CHUNK_SIZE]))
+            del self.buffer[:STREAM_CHUNK_SIZE]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer.clear()
+
+    def put(self, item):
+        while True:
+            if self.stopped.is_set():
+                raise StreamClosed()
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+
+def write_archive(fileobj, arc_format, directory):
+    if arc_format == 'zip':
+        with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as arc:
+            for path, arcname in walk_content(directory):
+                arc.write(path, arcname)
+    else:
+        with tarfile.open(fileobj=fileobj, mode=TAR_STREAM_MODES[arc_format]) as arc:
+            for path, arcname in walk_content(directory):
+                arc.add(path, arcname, recursive=False)
+
+
+def walk_content(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in dirs + sorted(files):
+            path = os.path.join(root, name)
+            yield path, os.path.relpath(path, directory)
+
+
+def copy_zip_member(source, target, info):
+    # The compressed bytes are copied as they are, so an untouched member is neither inflated nor deflated again
+    source.fp.seek(info.header_offset)
+    header = ZIP_LOCAL_HEADER.unpack(source.fp.read(ZIP_LOCAL_HEADER.size))
+    if header[0] != ZIP_LOCAL_SIGNATURE:
+        raise zipfile.BadZipFile('Bad local header of {}'.format(info.filename))
+    source.fp.seek(header[10] + header[11], os.SEEK_CUR)
+    member = copy.copy(info)
+    member.flag_bits &= ~ZIP_DATA_DESCRIPTOR_FLAG
+    member.header_offset = target.fp.tell()
+    target.fp.write(member.FileHeader())
+    remaining = info.compress_size
+    while remaining:
+        chunk = source.fp.read(min(STREAM_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise zipfile.BadZipFile('Truncated member {}'.format(info.filename))
+        target.fp.write(chunk)
+        remaining -= len(chunk)
+    target.filelist.append(member)
+    target.NameToInfo[member.filename] = member
+    target.start_dir = target.fp.tell()
+    target._didModify = True
+
+
+class ZipSource(object):
+
+    def __init__(self, filename):
+        self.arc = zipfile.ZipFile(filename)
+
+    def members(self):
+        for info in self.arc.infolist():
+            if os.path.normpath(info.filename) == '.':
+                continue
+            yield ArchiveMember(info.filename.rstrip('/'), info.is_dir(), info.file_size,
+                                time.mktime(info.date_time + (0, 0, -1)), info)
+
+    def open(self, member):
+        return self.arc.open(member.info)
+
+    def close(self):
+        self.arc.close()
+
+
+class TarSource(object):
+
+    def __init__(self, filename):
+        self.arc = tarfile.open(filename)
+
+    def members(self):
+        # Links and special files are left out, as they are by the archive listing
+        for info in self.arc:
+            if (info.isdir() or info.isfile()) and os.path.normpath(info.name) != '.':
+                yield ArchiveMember(info.name.rstrip('/'), info.isdir(), info.size, info.mtime, info)
+
+    def open(self, member):
+        return self.arc.extractfile(member.info)
+
+    def close(self):
+        self.arc.close()
+
+
+class ZipTarget(object):
+
+    def __init__(self, filename):
+        self.arc = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
+
+    def add_member(self, source, member):
+        if isinstance(source, ZipSource) and max(member.size, member.info.compress_size) <= zipfile.ZIP64_LIMIT:
+            copy_zip_member(source.arc, self.arc, member.info)
+            return
+        date_time = max(time.localtime(member.mtime)[:6], (1980, 1, 1, 0, 0, 0))
+        # Tar names such as ./dir/a.txt are stored the way ZipFile.write stores the converted members
+        name = os.path.normpath(member.name)
+        if member.is_dir:
+            info = zipfile.ZipInfo(name + '/', date_time)
+            info.external_attr = 0o40755 << 16 | 0x10
+            self.arc.writestr(info, b'')
+            return
+        info = zipfile.ZipInfo(name, date_time)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.file_size = member.size
+        with source.open(member) as src, self.arc.open(info, 'w') as dst:
+            shutil.copyfileobj(src, dst, STREAM_CHUNK_SIZE)
+
+    def add_file(self, path, name):
+        self.arc.write(path, name)
+
+    def close(self):
+        self.arc.close()
+
+
+class TarTarget(object):
+
+    def __init__(self, filename, arc_format):
+        self.arc = tarfile.open(filename, TAR_STREAM_MODES[arc_format])
+
+    def add_member(self, source, member):
+        if isinstance(source, TarSource):
+            info = copy.copy(member.info)
+        else:
+            info = tarfile.TarInfo(member.name)
+            info.size = 0 if member.is_dir else member.size
+            info.mtime = member.mtime
+            info.type = tarfile.DIRTYPE if member.is_dir else tarfile.REGTYPE
+            info.mode = 0o755 if member.is_dir else 0o644
+        if member.is_dir:
+            self.arc.addfile(info)
+            return
+        with source.open(member) as src:
+            self.arc.addfile(info, src)
+
+    def add_file(self, path, name):
+        self.arc.add(path, name, recursive=False)
+
+    def close(self):
+        self.arc.close()
+
+
+def pipeline(source, target, formats, scratch, budget, max_workers=None):
+    # Untouched members go straight from one archive to the other; a member to convert is written to its own
+    # scratch folder, converted in the pool and added once done, so only the members in flight touch the disk
+    errors = dict()
+    in_flight = dict()
+    limit = (max_workers or os.cpu_count() or 1) * PIPELINE_MEMBERS_PER_WORKER
+
+    def finish(future):
+        member, folder, new_format = in_flight.pop(future)
+        result = conversion_errors(future, new_format)
+        if result:
+            errors[member.name] = result
+        for file in sorted(os.listdir(folder)):
+            target.add_file(os.path.join(folder, file), os.path.join(os.path.dirname(member.name), file))
+        shutil.rmtree(folder)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for number, member in enumerate(source.members()):
+            budget.admit(member)
+            new_format = None if member.is_dir else formats.get(os.path.normpath(member.name))
+            if new_format is None:
+                target.add_member(source, member)
+                continue
+            folder = os.path.join(scratch, str(number))
+            filename = os.path.basename(member.name)
+            os.mkdir(folder)
+            with source.open(member) as src, open(os.path.join(folder, filename), 'wb') as dst:
+                budget.copy(src, dst)
+            in_flight[executor.submit(convert_member, folder, filename, new_format)] = member, folder, new_format
+            if len(in_flight) >= limit:
+                for future in wait(in_flight, return_when=FIRST_COMPLETED).done:
+                    finish(future)
+        while in_flight:
+            for future in wait(in_flight, return_when=FIRST_COMPLETED).done:
+                finish(future)
+    return errors
 
 
 class ArchiveFuncs(object):
@@ -21,21 +325,159 @@ class ArchiveFuncs(object):
         else:
             self.filename = filename
 
+    def budget(self):
+        return ARCHIVE_LIMITS.budget(os.path.getsize(self.original_file))
+
+    def source(self):
+        if FORMAT_TO_SUFFIXES.get(self.suffix) == 'zip':
+            return ZipSource(self.original_file)
+        return TarSource(self.original_file)
+
     def extract_archive(self):
         try:
-            directory = os.path.join(self.path, ARCHIVE_CONTENT_FOLDER)
-            if os.path.exists(directory):
-                shutil.rmtree(directory)
-            os.mkdir(directory)
-            shutil.unpack_archive(self.original_file, directory, FORMAT_TO_SUFFIXES.get(self.suffix))
+            STORAGE.localize(self.original_file)
+            STORAGE.scratch_dir(self.path, ARCHIVE_CONTENT_FOLDER)
+            budget = self.budget()
+            source = self.source()
+            try:
+                for member in source.members():
+                    budget.admit(member)
+                    target = self.member_path(member.name)
+                    if member.is_dir:
+                        os.makedirs(target, exist_ok=True)
+                        continue
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    with source.open(member) as src, open(target, 'wb') as dst:
+                        budget.copy(src, dst)
+            finally:
+                source.close()
         except Exception as e:
+            # Whatever was unpacked before the failure is of no use and may be large
+            STORAGE.remove_dir(self.path, ARCHIVE_CONTENT_FOLDER)
             return 'error', e
 
     def make_archive(self, arc_format):
         try:
             filename = shutil.make_archive(os.path.join(self.path, self.filename),
                                            arc_format, os.path.join(self.path, ARCHIVE_CONTENT_FOLDER))
-            return '/'.join(filename.split('/')[-3:])
+            STORAGE.publish(filename)
+            return os.path.relpath(filename)
+        except Exception as e:
+            return 'error', e
+
+    def convert_archive(self, name, arc_format, formats, max_workers=None):
+        filename = os.path.join(self.path, name + ARCHIVE_EXTENSIONS.get(arc_format, ''))
+        try:
+            STORAGE.localize(self.original_file)
+            scratch = STORAGE.scratch_dir(self.path, PIPELINE_FOLDER)
+            budget = self.budget()
+            source = self.source()
+            try:
+                target = ZipTarget(filename) if arc_format == 'zip' else TarTarget(filename, arc_format)
+                try:
+                    errors = pipeline(source, target, formats, scratch, budget, max_workers)
+                finally:
+                    target.close()
+            finally:
+                source.close()
+                STORAGE.remove_dir(self.path, PIPELINE_FOLDER)
+            STORAGE.publish(filename)
+            return {'path': os.path.relpath(filename), 'errors': errors}
+        except Exception as e:
+            # A half written archive can be as large as the limits allow
+            if os.path.isfile(filename):
+                os.remove(filename)
+            return 'error', e
+
+    def stream_archive(self, arc_format):
+        # The archive is built in a helper thread, so bytes reach the client while later members are compressed
+        if arc_format != 'zip' and arc_format not in TAR_STREAM_MODES:
+            raise ValueError('Unsupported archive format {}'.format(arc_format))
+        directory = os.path.join(self.path, ARCHIVE_CONTENT_FOLDER)
+        chunks = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+        stopped = threading.Event()
+
+        def produce():
+            writer = QueueWriter(chunks, stopped)
+            try:
+                write_archive(writer, arc_format, directory)
+                writer.close()
+                writer.put(None)
+            except StreamClosed:
+                pass
+            except Exception as e:
+                try:
+                    writer.put(e)
+                except StreamClosed:
+                    pass
+
+        threading.Thread(target=produce, daemon=True).start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            stopped.set()
+
+    def list_files(self):
+        # Reads the zip central directory or the tar headers, nothing is written to disk
+        content_of_dir = dict(dirs=list(), files_full=list(), files=list())
+        directory = os.path.join(self.path, ARCHIVE_CONTENT_FOLDER)
+        try:
+            budget = self.budget()
+            source = self.source()
+            try:
+                for member in source.members():
+                    budget.admit(member)
+                    if not member.is_dir:
+                        compressed_size = member.info.compress_size if isinstance(source, ZipSource) else None
+                        content_of_dir['files'].append((os.path.join(directory, member.name), member.name,
+                                                        member.size, compressed_size))
+            finally:
+                source.close()
+        except Exception as e:
+            return 'error', e
+        return content_of_dir, '{}{}'.format(self.filename, self.suffix)
+
+    def member_path(self, name):
+        directory = os.path.abspath(os.path.join(self.path, ARCHIVE_CONTENT_FOLDER))
+        target = os.path.abspath(os.path.join(directory, name))
+        if not target.startswith(directory + os.sep):
+            raise ValueError('Archive member {} is outside of the archive'.format(name))
+        return target
+
+    def extract_member(self, name):
+        try:
+            target = self.member_path(name)
+            STORAGE.localize(self.original_file)
+            if not os.path.exists(os.path.join(self.path, ARCHIVE_CONTENT_FOLDER)):
+                STORAGE.scratch_dir(self.path, ARCHIVE_CONTENT_FOLDER)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            budget = self.budget()
+            source = self.source()
+            try:
+                for member in source.members():
+                    budget.admit(member)
+                    if os.path.normpath(member.name) == os.path.normpath(name) and not member.is_dir:
+                        break
+                else:
+                    raise KeyError(name)
+                try:
+                    with source.open(member) as src, open(target, 'wb') as dst:
+                        budget.copy(src, dst)
+                except Exception:
+                    # A partial file would be served as the member on the next request
+                    if os.path.exists(target):
+                        os.remove(target)
+                    raise
+            finally:
+                source.close()
+            STORAGE.publish(target)
+            return target
         except Exception as e:
             return 'error', e
 
@@ -44,8 +486,8 @@ class ArchiveFuncs(object):
         for root, dirs, files in os.walk(os.path.join(self.path, ARCHIVE_CONTENT_FOLDER)):
             content_of_dir['dirs'].extend(dirs)
             for file in files:
-                content_of_dir['files'].append((os.path.join(root, file),
-                                                '/'.join(os.path.join(root, file).split('/')[3:])))
+                content_of_dir['files'].append((os.path.join(root, file), os.path.relpath(
+                    os.path.join(root, file), os.path.join(self.path, ARCHIVE_CONTENT_FOLDER))))
         return content_of_dir, '{}{}'.format(self.filename, self.suffix)
 
 
@@ -0,0 +1,250 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+
+from PIL import Image, __version__ as PILLOW_VERSION
+
+from archive_functions import ArchiveFuncs, ARCHIVE_CONTENT_FOLDER
+from cache import RESULT_CACHE
+from convert_functions import PictureConverter, AudioConverter, VideoConverter, \
+    PICTURE_SUPPORTED_FORMATS, AUDIO_SUPPORTED_FORMATS, VIDEO_SUPPORTED_FORMATS
+
+SEED = 1234
+IMAGE_SIZES = [(640, 480), (1920, 1080), (4000, 3000)]
+AUDIO_DURATION = 30
+VIDEO_DURATION = 10
+VIDEO_SIZE = '1280x720'
+BENCHMARK_ARCHIVE_FORMATS = ['zip', 'gztar']
+FFMPEG_BITEXACT = ['-fflags', '+bitexact', '-flags:v', '+bitexact', '-flags:a', '+bitexact']
+CONVERTERS = {'picture': PictureConverter, 'audio': AudioConverter, 'video': VideoConverter}
+
+
+def ffmpeg(*args):
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error'] + list(args), check=True)
+
+
+def make_image(path, size):
+    rng = random.Random(SEED)
+    gradient = Image.linear_gradient('L').resize(size).convert('RGB')
+    noise = Image.frombytes('RGB', size, rng.randbytes(size[0] * size[1] * 3))
+    Image.blend(gradient, noise, 0.25).save(path)
+
+
+def make_fixtures(directory):
+    os.makedirs(directory, exist_ok=True)
+    fixtures = dict()
+    for size in IMAGE_SIZES:
+        path = os.path.join(directory, 'image_{}x{}.png'.format(*size))
+        if not os.path.exists(path):
+            make_image(path, size)
+        fixtures['image_{}x{}'.format(*size)] = path
+    audio = os.path.join(directory, 'audio.wav')
+    if not os.path.exists(audio):
+        ffmpeg('-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=44100:duration={}'.format(AUDIO_DURATION),
+               '-ac', '2', *FFMPEG_BITEXACT, audio)
+    fixtures['audio'] = audio
+    video = os.path.join(directory, 'video.mp4')
+    if not os.path.exists(video):
+        ffmpeg('-f', 'lavfi', '-i', 'testsrc=size={}:rate=30:duration={}'.format(VIDEO_SIZE, VIDEO_DURATION),
+               '-f', 'lavfi', '-i', 'sine=frequency=440:duration={}'.format(VIDEO_DURATION),
+               '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-shortest', *FFMPEG_BITEXACT, video)
+    fixtures['video'] = video
+    members = [fixtures['image_640x480'], fixtures['image_1920x1080'], audio]
+    archive = os.path.join(directory, 'archive.zip')
+    if not os.path.exists(archive):
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as arc:
+            for member in members:
+                arc.write(member, os.path.join('media', os.path.basename(member)))
+            arc.writestr('readme.txt', 'benchmark fixture\n' * 1000)
+    fixtures['archive_zip'] = archive
+    archive = os.path.join(directory, 'archive.tar.gz')
+    if not os.path.exists(archive):
+        with tarfile.open(archive, 'w:gz') as arc:
+            for member in members:
+                arc.add(member, os.path.join('media', os.path.basename(member)))
+    fixtures['archive_gztar'] = archive
+    return fixtures
+
+
+def build_cases(fixtures):
+    cases = list()
+    for size in IMAGE_SIZES:
+        name = 'image_{}x{}'.format(*size)
+        cases.extend(('picture/{}/{}'.format(name, fmt), 'picture', fixtures[name], fmt)
+                     for fmt in PICTURE_SUPPORTED_FORMATS)
+    cases.extend(('audio/{}'.format(fmt), 'audio', fixtures['audio'], fmt) for fmt in AUDIO_SUPPORTED_FORMATS)
+    cases.extend(('video/{}'.format(fmt), 'video', fixtures['video'], fmt) for fmt in VIDEO_SUPPORTED_FORMATS)
+    for arc_format in BENCHMARK_ARCHIVE_FORMATS:
+        archive = fixtures['archive_{}'.format(arc_format)]
+        cases.append(('archive/extract/{}'.format(arc_format), 'extract', archive, None))
+        cases.append(('archive/make/{}'.format(arc_format), 'make', fixtures['archive_zip'], arc_format))
+        cases.append(('archive/convert/{}'.format(arc_format), 'convert', fixtures['archive_zip'], arc_format))
+    return cases
+
+
+def prepare_case(kind, fixture, target, workdir):
+    filename = os.path.basename(fixture)
+    shutil.copyfile(fixture, os.path.join(workdir, filename))
+    if kind in CONVERTERS:
+        converter = CONVERTERS[kind](workdir, filename)
+
+        def convert():
+            result = converter.convert(target)
+            if not isinstance(result, dict):
+                raise result
+            return result['new_file_path']
+        return convert
+    arc = ArchiveFuncs(workdir, filename)
+    if kind == 'make':
+        arc.extract_archive()
+
+        def make():
+            result = arc.make_archive(target)
+            if isinstance(result, tuple):
+                raise result[1]
+            return os.path.join(workdir, os.path.basename(result))
+        return make
+    if kind == 'convert':
+
+        def repack():
+            result = arc.convert_archive('repacked', target, dict())
+            if isinstance(result, tuple):
+                raise result[1]
+            return os.path.join(workdir, os.path.basename(result['path']))
+        return repack
+
+    def extract():
+        result = arc.extract_archive()
+        if isinstance(result, tuple):
+            raise result[1]
+        return os.path.join(workdir, ARCHIVE_CONTENT_FOLDER)
+    return extract
+
+
+def output_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(path) for file in files)
+    return os.path.getsize(path)
+
+
+def peak_rss():
+    # ru_maxrss survives exec on Linux, so a spawned child would report its parent's peak; VmHWM does not
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(kind, fixture, target, results):
+    # Runs in a fresh process so that peak RSS belongs to this case only
+    RESULT_CACHE.enabled = False
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        action = prepare_case(kind, fixture, target, workdir)
+        self_before = resource.getrusage(resource.RUSAGE_SELF)
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        started = time.perf_counter()
+        output = action()
+        wall = time.perf_counter() - started
+        self_after = resource.getrusage(resource.RUSAGE_SELF)
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = sum(getattr(after, field) - getattr(before, field)
+                  for before, after in ((self_before, self_after), (children_before, children_after))
+                  for field in ('ru_utime', 'ru_stime'))
+        results.put({'wall_time': wall, 'cpu_time': cpu, 'output_size': output_size(output),
+                     'peak_rss': max(peak_rss(), children_after.ru_maxrss * 1024)})
+    except Exception as e:
+        results.put({'error': '{}: {}'.format(type(e).__name__, e)})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_benchmarks(cases, repeat):
+    context = multiprocessing.get_context('spawn')
+    report = dict()
+    for case_id, kind, fixture, target in cases:
+        runs = list()
+        for _ in range(repeat):
+            results = context.Queue()
+            process = context.Process(target=measure, args=(kind, fixture, target, results))
+            process.start()
+            runs.append(results.get())
+            process.join()
+        errors = [run for run in runs if 'error' in run]
+        report[case_id] = errors[0] if errors else min(runs, key=lambda run: run['wall_time'])
+        print('{:<40} {}'.format(case_id, report[case_id].get('error') or '{:.3f}s'.format(
+            report[case_id]['wall_time'])), file=sys.stderr)
+    return report
+
+
+def ffmpeg_version():
+    try:
+        return subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True).stdout.split('\n')[0]
+    except OSError:
+        return None
+
+
+def compare(report, baseline, threshold):
+    regressions = list()
+    for case_id, current in sorted(report['results'].items()):
+        previous = baseline['results'].get(case_id)
+        if previous is None or 'error' in previous or 'error' in current:
+            print('{:<40} {}'.format(case_id, current.get('error', 'new')))
+            continue
+        changes = {metric: (current[metric] - previous[metric]) / previous[metric] if previous[metric] else 0.0
+                   for metric in ('wall_time', 'cpu_time', 'peak_rss', 'output_size')}
+        print('{:<40} '.format(case_id) + ' '.join('{} {:+.1%}'.format(metric, change)
+                                                   for metric, change in changes.items()))
+        if changes['wall_time'] > threshold or changes['peak_rss'] > threshold:
+            regressions.append(case_id)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the picture, audio, video and archive converters')
+    parser.add_argument('--fixtures', default=os.path.join(tempfile.gettempdir(), 'converter-bench-fixtures'),
+                        help='directory for the generated fixtures, reused between runs')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative wall time or peak RSS growth reported as a regression')
+    parser.add_argument('--filter', default='', help='only run cases whose id contains this string')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case, the fastest one is kept')
+    args = parser.parse_args()
+
+    fixtures = make_fixtures(args.fixtures)
+    cases = [case for case in build_cases(fixtures) if args.filter in case[0]]
+    report = {'meta': {'python': platform.python_version(), 'platform': platform.platform(),
+                       'pillow': PILLOW_VERSION, 'ffmpeg': ffmpeg_version(), 'repeat': args.repeat},
+              'results': run_benchmarks(cases, args.repeat)}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(report, json.load(file), args.threshold)
+        if regressions:
+            print('Regressions: {}'.format(', '.join(regressions)), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
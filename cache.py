@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+
+CACHE_DIRECTORY = 'cache/'
+CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+CACHE_ENABLED = True
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def place_file(source, destination):
+    # Hard links keep a cache hit free of copying; fall back to a copy across filesystems
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class ResultCache(object):
+
+    def __init__(self, directory=CACHE_DIRECTORY, max_size=CACHE_MAX_SIZE, enabled=CACHE_ENABLED):
+        self.directory = directory
+        self.max_size = max_size
+        self.enabled = enabled
+        self.size = None
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.directory = app.config.get('CACHE_DIRECTORY', CACHE_DIRECTORY)
+        self.max_size = app.config.get('CACHE_MAX_SIZE', CACHE_MAX_SIZE)
+        self.enabled = app.config.get('CACHE_ENABLED', CACHE_ENABLED)
+        self.size = None
+
+    @staticmethod
+    def key(digest, converter, new_format, options=None, version=1):
+        # version changes whenever a converter writes different output for the same options
+        payload = json.dumps([digest, converter, version, new_format.upper(), options or {}], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key, destination):
+        if not self.enabled:
+            return False
+        entry = self.entry_path(key)
+        try:
+            os.utime(entry)
+            if os.path.exists(destination):
+                os.remove(destination)
+            place_file(entry, destination)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, source):
+        if not self.enabled:
+            return
+        entry = self.entry_path(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        temp = '{}.{}.tmp'.format(entry, uuid.uuid4().hex)
+        place_file(source, temp)
+        try:
+            replaced = os.path.getsize(entry)
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(temp, entry)
+        with self.lock:
+            if self.size is not None:
+                self.size += os.path.getsize(entry) - replaced
+        if self.size is None or self.size > self.max_size:
+            self.evict()
+
+    def entries(self):
+        for root, dirs, files in os.walk(self.directory):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def evict(self):
+        # The running total is only this process's view, every eviction recounts the whole cache.
+        # Evicting down to 90% of the budget keeps the walk from repeating on the next put
+        with self.lock:
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            if total > self.max_size:
+                for _, size, path in entries:
+                    if total <= self.max_size * 0.9:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+            self.size = total
+
+
+RESULT_CACHE = ResultCache()
@@ -1,4 +1,9 @@
+from sqlalchemy.pool import QueuePool
+
+
 class Config(object):
+    ACTIVITY_FLUSH_INTERVAL = 30
+
     JOBS = [
         {
             'id': 'job1',
@@ -6,15 +11,39 @@ class Config(object):
             'args': (),
             'trigger': 'interval',
             'minutes': 30
+        },
+        {
+            'id': 'job2',
+            'func': 'db:flush_activity',
+            'args': (),
+            'trigger': 'interval',
+            'seconds': ACTIVITY_FLUSH_INTERVAL
         }
     ]
 
     SCHEDULER_API_ENABLED = True
 
+    OPERATION_TTL = 10800
+
+    FILES_DISK_BUDGET = None
+
     SECRET_KEY = 'super_secret_key_for_project_00023'
 
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///converter.db'
+
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    SQLALCHEMY_ENGINE_OPTIONS = {'poolclass': QueuePool, 'pool_size': 5, 'max_overflow': 10, 'pool_recycle': 3600,
+                                 'pool_pre_ping': True, 'connect_args': {'timeout': 5, 'check_same_thread': False}}
+
+    SQLITE_JOURNAL_MODE = 'WAL'
+
+    SQLITE_BUSY_TIMEOUT = 5000
+
+    SQLITE_SYNCHRONOUS = 'NORMAL'
+
+    USER_CACHE_TTL = 30
+
     MAIL_SERVER = 'smtp.mail.ru'
 
     MAIL_USERNAME = ''
@@ -27,4 +56,103 @@ class Config(object):
 
     MAIL_SUPPRESS_SEND = False
 
+    MAIL_BACKEND = 'smtp'
+
+    MAIL_BATCH_SIZE = 20
+
+    MAIL_RETRIES = 5
+
+    MAIL_RETRY_BACKOFF = 2
+
+    MAIL_LOCAL_DELAY = 0
+
+    CONVERT_WORKERS = None
+
+    JOB_QUEUE_LIMIT = 100
+
+    API_MAX_BATCH_ITEMS = 50
+
+    ADMISSION_JOBS_PER_CORE = 1
+
+    ADMISSION_MEMORY_BUDGET = None
+
+    ADMISSION_JOB_MEMORY = {'picture': 512 * 1024 * 1024, 'audio': 128 * 1024 * 1024, 'video': 768 * 1024 * 1024,
+                            'archive': 768 * 1024 * 1024}
+
+    ADMISSION_USER_JOBS = 50
+
+    ADMISSION_SESSION_JOBS = 10
+
+    ADMISSION_RETRY_AFTER = 30
+
+    ADMISSION_LOCK_DIRECTORY = None
+
+    ADMISSION_POLL_INTERVAL = 1
+
+    ADMISSION_WAIT = 30
+
+    UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+    UPLOAD_SPOOL_TTL = 3600
+
+    PROGRESS_POLL_INTERVAL = 1
+
+    PROGRESS_STREAM_TIMEOUT = 15
+
+    PROGRESS_STREAM_RETRY = 3
+
+    ARCHIVE_CONVERT_WORKERS = None
+
+    ARCHIVE_STREAMING = False
+
+    ARCHIVE_MAX_MEMBERS = 10000
+
+    ARCHIVE_MAX_SIZE = 1024 * 1024 * 1024
+
+    ARCHIVE_MAX_RATIO = 100
+
+    ARCHIVE_MAX_DEPTH = 32
+
+    PICTURE_MAX_PIXELS = 400 * 1000 * 1000
+
+    PICTURE_MAX_MEMORY = 2 * 1024 * 1024 * 1024
+
+    DOWNLOAD_OFFLOAD = None
+
+    DOWNLOAD_ACCEL_PREFIX = '/protected-files/'
+
+    STORAGE_BACKEND = 'local'
+
+    STORAGE_SHARD_WIDTH = 2
+
+    STORAGE_SCRATCH_DIRECTORY = None
+
+    STORAGE_S3_BUCKET = None
+
+    STORAGE_S3_PREFIX = ''
+
+    STORAGE_S3_ENDPOINT = None
+
+    STORAGE_S3_STANDIN_DIRECTORY = None
+
+    CACHE_ENABLED = True
+
+    CACHE_DIRECTORY = 'cache/'
+
+    CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
+    METRICS_ENABLED = True
+
+    METRICS_DISK_USAGE_TTL = 60
+
+    PROFILE_ENABLED = False
+
+    PROFILE_SAMPLE_RATE = 0.0
+
+    PROFILE_HEADER = 'X-Profile'
+
+    PROFILE_SECRET = None
+
+    PROFILE_DIRECTORY = 'profiles/'
+
     TESTING = False
@@ -1,134 +1,453 @@
+import json
 import os
+import re
+import resource
+import struct
+import threading
+import time
 import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 import ffmpeg
 from PIL import Image
 from pydub import AudioSegment
 
+from cache import RESULT_CACHE, file_digest
+from metrics import CONVERSION_SECONDS, ERRORS
+
 PICTURE_SUPPORTED_FORMATS = ['WEBP', 'BMP', 'PPM',
                              'JPEG', 'TIFF', 'GIF', 'PNG', 'SGI', 'JPG']
 AUDIO_SUPPORTED_FORMATS = ['MP3', 'WAV', 'OGG', 'FLAC', 'OPUS']
 VIDEO_SUPPORTED_FORMATS = ['AVI', 'GIF', 'OGG', 'FLV', 'MKV', 'MP4']
+AUDIO_ENGINE = 'ffmpeg'
+IMAGE_STRIP_BYTES = 16 * 1024 * 1024
+PROGRESS_WRITE_INTERVAL = 0.5
+DURATION_PATTERN = re.compile(rb'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+REMUX_CODECS = {'MP4': {'video': {'h264', 'hevc', 'mpeg4', 'av1'},
+                        'audio': {'aac', 'mp3', 'ac3', 'alac', 'opus', 'flac'}},
+                'MKV': {'video': {'h264', 'hevc', 'mpeg4', 'mpeg2video', 'vp8', 'vp9', 'av1', 'theora'},
+                        'audio': {'aac', 'mp3', 'ac3', 'opus', 'vorbis', 'flac', 'pcm_s16le'}},
+                'FLV': {'video': {'h264', 'flv1'},
+                        'audio': {'aac', 'mp3'}},
+                'AVI': {'video': {'mpeg4', 'h264', 'mjpeg', 'msmpeg4v3'},
+                        'audio': {'mp3', 'ac3', 'pcm_s16le'}},
+                'OGG': {'video': {'theora'},
+                        'audio': {'vorbis', 'opus', 'flac'}}}
+
+
+class ProgressReport(object):
+    """Turns the key=value blocks of ffmpeg -progress into a small JSON file the web process can read."""
+
+    def __init__(self, path, source):
+        self.path = path
+        self.started = time.monotonic()
+        self.written = 0
+        self.state = dict()
+        try:
+            self.duration = float(ffmpeg.probe(source)['format']['duration'])
+        except Exception:
+            self.duration = None
+        self.write({'status': 'running', 'percent': 0})
+
+    def sniff(self, line):
+        # Fallback when ffprobe is missing: ffmpeg logs the input duration before it starts encoding
+        match = DURATION_PATTERN.search(line)
+        if self.duration is None and match:
+            hours, minutes, seconds = match.groups()
+            self.duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    def feed(self, line):
+        key, _, value = line.strip().partition('=')
+        self.state[key] = value
+        if key != 'progress':
+            return
+        if value == 'end':
+            self.finish()
+        elif time.monotonic() - self.written >= PROGRESS_WRITE_INTERVAL:
+            self.write(self.report())
+
+    def report(self):
+        # out_time_ms is in microseconds as well, it is only used by ffmpeg builds without out_time_us
+        try:
+            position = int(self.state.get('out_time_us') or self.state.get('out_time_ms')) / 1000000
+        except (TypeError, ValueError):
+            position = 0
+        elapsed = time.monotonic() - self.started
+        report = {'status': 'running', 'position': position, 'duration': self.duration,
+                  'speed': self.state.get('speed', '').strip().rstrip('x') or None, 'frame': self.state.get('frame'),
+                  'percent': None, 'eta': None}
+        if self.duration and position > 0:
+            report['percent'] = min(100.0, 100.0 * position / self.duration)
+            report['eta'] = max(0.0, elapsed * (self.duration - position) / position)
+        return report
+
+    def finish(self):
+        self.write({'status': 'done', 'percent': 100, 'eta': 0, 'duration': self.duration})
+
+    def write(self, report):
+        temp = '{}.tmp'.format(self.path)
+        with open(temp, 'w') as file:
+            json.dump(report, file)
+        os.replace(temp, self.path)
+        self.written = time.monotonic()
+
+
+def run_measured(stream, progress=None):
+    # Reaping ffmpeg with wait4 gives the resource usage of exactly this child process
+    started = time.monotonic()
+    if progress is not None:
+        stream = stream.global_args('-progress', 'pipe:1', '-nostats')
+    process = ffmpeg.run_async(stream, pipe_stdout=progress is not None, pipe_stderr=True, overwrite_output=True)
+    if progress is not None:
+        # stderr is drained on a thread so that neither pipe can fill up and block ffmpeg
+        errors = list()
 
+        def drain():
+            for line in process.stderr:
+                errors.append(line)
+                progress.sniff(line)
+        reader = threading.Thread(target=drain, daemon=True)
+        reader.start()
+        for line in process.stdout:
+            progress.feed(line.decode(errors='replace'))
+        process.stdout.close()
+        reader.join()
+        stderr = b''.join(errors)
+    else:
+        stderr = process.stderr.read()
+    process.stderr.close()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    if process.returncode:
+        raise ffmpeg.Error('ffmpeg', None, stderr)
+    return {'engine': 'ffmpeg', 'peak_memory': usage.ru_maxrss * 1024, 'wall_time': time.monotonic() - started}
+
+
+def cached_conversion(converter, new_format, produce):
+    new_file_path = os.path.join(converter.path, '{}.{}'.format(converter.filename, new_format.lower()))
+    if not RESULT_CACHE.enabled:
+        produce()
+        return new_file_path
+    digest = converter.digest or file_digest(converter.original_file)
+    key = RESULT_CACHE.key(digest, type(converter).__name__, new_format, converter.encoder_options.get(new_format),
+                           converter.version)
+    if not RESULT_CACHE.get(key, new_file_path):
+        produce()
+        RESULT_CACHE.put(key, new_file_path)
+    return new_file_path
+
+
+class ImageLimitError(Exception):
+    pass
+
+
+class ImageLimits(object):
+    """Pixel and memory budget checked from the image header, before anything is decoded."""
+
+    def __init__(self, app=None):
+        self.max_pixels = None
+        self.max_memory = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_pixels = app.config.get('PICTURE_MAX_PIXELS')
+        self.max_memory = app.config.get('PICTURE_MAX_MEMORY')
+        if self.max_pixels is not None:
+            # Pillow's decompression bomb check would warn or fail on images this budget allows
+            Image.MAX_IMAGE_PIXELS = None
+
+    def check(self, size, memory):
+        width, height = size
+        if self.max_pixels is not None and width * height > self.max_pixels:
+            raise ImageLimitError('The image has {}x{} pixels, the limit is {:g} megapixels'.format(
+                width, height, self.max_pixels / 1000000))
+        if self.max_memory is not None and memory > self.max_memory:
+            raise ImageLimitError('Converting the image needs about {} MB of memory, the limit is {} MB'.format(
+                memory // 1024 // 1024, self.max_memory // 1024 // 1024))
+
+
+IMAGE_LIMITS = ImageLimits()
+
+
+def pixel_bytes(mode):
+    # Pillow keeps 1, L and P images at a byte per pixel, 16-bit modes at two and every other mode at four
+    if mode in ('1', 'L', 'P'):
+        return 1
+    if mode.startswith('I;16'):
+        return 2
+    return 4
+
+
+def image_strips(image, rows, bottom_up=False):
+    width, height = image.size
+    tops = range(0, height, rows)
+    for top in reversed(tops) if bottom_up else tops:
+        strip = image.crop((0, top, width, min(height, top + rows)))
+        rgb = strip.convert('RGB')
+        strip.close()
+        yield rgb
+        rgb.close()
+
+
+def write_ppm(image, path):
+    width, height = image.size
+    with open(path, 'wb') as file:
+        file.write(b'P6\n%d %d\n255\n' % (width, height))
+        for strip in image_strips(image, max(1, IMAGE_STRIP_BYTES // (width * 4))):
+            file.write(strip.tobytes())
 
-class PictureConverter(object):
 
-    def __init__(self, path, filename):
+def write_bmp(image, path):
+    width, height = image.size
+    stride = (width * 3 + 3) & ~3
+    with open(path, 'wb') as file:
+        file.write(b'BM' + struct.pack('<IHHI', 54 + stride * height, 0, 0, 54))
+        file.write(struct.pack('<IiiHHIIiiII', 40, width, height, 1, 24, 0, stride * height, 2835, 2835, 0, 0))
+        # BMP stores the rows bottom-up, so the strips are written starting from the bottom of the image
+        for strip in image_strips(image, max(1, IMAGE_STRIP_BYTES // (width * 4)), bottom_up=True):
+            file.write(strip.tobytes('raw', 'BGR', stride, -1))
+
+
+class PictureConverter(object):
+    # Part of the result cache key, bumped whenever the same options start producing different output
+    version = 2
+    encoder_options = {'JPEG': {'quality': 90, 'optimize': True}, 'JPG': {'quality': 90, 'optimize': True},
+                       'PNG': {'optimize': False, 'compress_level': 6}, 'WEBP': {'quality': 80, 'method': 4},
+                       'GIF': {'optimize': True}, 'TIFF': {'compression': 'tiff_lzw'}}
+    pillow_formats = {'JPG': 'JPEG'}
+    save_modes = {'BMP': {'1', 'L', 'P', 'RGB', 'RGBA'}, 'GIF': {'1', 'L', 'P', 'RGB', 'RGBA'},
+                  'JPEG': {'L', 'RGB'}, 'JPG': {'L', 'RGB'}, 'PNG': {'1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'I', 'I;16'},
+                  'WEBP': {'RGB', 'RGBA'}, 'TIFF': {'1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'CMYK', 'I', 'F', 'I;16'},
+                  'PPM': {'1', 'L', 'RGB'}, 'SGI': {'L', 'RGB', 'RGBA'}, 'MSP': {'1'}, 'PCX': {'1', 'L', 'P', 'RGB'},
+                  'XBM': {'1'}}
+    strip_writers = {'PPM': write_ppm, 'BMP': write_bmp}
+
+    def __init__(self, path, filename, digest=None):
         self.convertations = {'BMP': self.to_bmp, 'GIF': self.to_gif, 'JPEG': self.to_jpeg, 'PNG': self.to_png,
                               'MSP': self.to_msp, 'PCX': self.to_pcx, 'PPM': self.to_ppm, 'SGI': self.to_sgi,
                               'TIFF': self.to_tiff, 'WEBP': self.to_webp, 'XBM': self.to_xbm,
-                              'JPG': self.to_jpeg}
+                              'JPG': self.to_jpg}
         self.path = path
         self.file_suffix = Path(filename).suffix
         self.filename = filename[:filename.rfind(Path(filename).suffix)]
         self.original_file = os.path.join(path, filename)
-
-    def get_image_object(self):
-        im = Image.open(self.original_file)
-        rgb_im = im.convert('RGB')
-        return rgb_im
+        self.digest = digest
+        self.image = None
+
+    def get_image_object(self, new_format):
+        # The decoded image is kept so that several targets can be written from a single decode
+        if self.image is None:
+            with Image.open(self.original_file) as im:
+                IMAGE_LIMITS.check(im.size, self.memory_needed(im, new_format))
+                im.load()
+                self.image = im
+        else:
+            IMAGE_LIMITS.check(self.image.size, self.memory_needed(self.image, new_format))
+        return self.image
+
+    def save_mode(self, image, new_format):
+        # The source mode is kept whenever the target can store it, which saves a full-size copy
+        modes = self.save_modes.get(new_format)
+        if modes is None or image.mode in modes:
+            return image.mode
+        if 'RGBA' in modes and (image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info):
+            return 'RGBA'
+        return 'RGB'
+
+    def memory_needed(self, image, new_format):
+        pixels = image.size[0] * image.size[1]
+        needed = pixels * pixel_bytes(image.mode)
+        mode = self.save_mode(image, new_format)
+        if mode != image.mode and not (mode == 'RGB' and new_format in self.strip_writers):
+            needed += pixels * pixel_bytes(mode)
+        return needed
+
+    def release_image(self):
+        if self.image is not None:
+            self.image.close()
+            self.image = None
 
     def convert(self, new_format):
         try:
             if self.original_file == os.path.join(self.path, '{}.{}'.format(self.filename, new_format.lower())):
                 self.filename = '{}{}'.format(uuid.uuid4().hex, self.filename)
             func = self.convertations.get(new_format)
-            func()
+            new_file_path = cached_conversion(self, new_format, func)
             os.remove(self.original_file)
-            return {'old_file_path': self.original_file,
-                    'new_file_path': os.path.join(self.path, '{}.{}'.format(self.filename, new_format.lower()))}
+            return {'old_file_path': self.original_file, 'new_file_path': new_file_path}
         except Exception as e:
             return e
+        finally:
+            self.release_image()
+
+    def convert_many(self, new_formats):
+        results = dict()
+        if any(self.original_file == os.path.join(self.path, '{}.{}'.format(self.filename, new_format.lower()))
+               for new_format in new_formats):
+            self.filename = '{}{}'.format(uuid.uuid4().hex, self.filename)
+        try:
+            for new_format in new_formats:
+                # Each format is timed on its own; the first one also pays for the decode
+                started = time.monotonic()
+                try:
+                    func = self.convertations.get(new_format)
+                    results[new_format] = {'old_file_path': self.original_file,
+                                           'new_file_path': cached_conversion(self, new_format, func),
+                                           'elapsed': time.monotonic() - started}
+                except Exception as e:
+                    results[new_format] = e
+        finally:
+            self.release_image()
+        if any(isinstance(result, dict) for result in results.values()):
+            os.remove(self.original_file)
+        return results
+
+    def save(self, new_format):
+        image = self.get_image_object(new_format)
+        path = os.path.join(self.path, '{}.{}'.format(self.filename, new_format.lower()))
+        mode = self.save_mode(image, new_format)
+        if mode == 'RGB' != image.mode and new_format in self.strip_writers:
+            # Uncompressed targets are written a strip at a time, the converted copy never exists in full
+            self.strip_writers[new_format](image, path)
+            return
+        if mode != image.mode:
+            image = image.convert(mode)
+        try:
+            image.save(path, format=self.pillow_formats.get(new_format, new_format),
+                       **self.encoder_options.get(new_format, dict()))
+        finally:
+            if image is not self.image:
+                image.close()
 
     def to_bmp(self):
-        self.get_image_object().save(os.path.join(self.path, '{}.bmp'.format(self.filename)))
+        self.save('BMP')
 
     def to_gif(self):
-        self.get_image_object().save(os.path.join(self.path, '{}.gif'.format(self.filename)))
+        self.save('GIF')
 
     def to_jpeg(self):
-        self.get_image_object().save(os.path.join(self.path, '{}.jpeg'.format(self.filename)))
+        self.save('JPEG')
+
+    def to_jpg(self):
+        self.save('JPG')
 
     def to_png(self):
-        self.get_image_object().save(os.path.join(self.path, '{}.png'.format(self.filename)))
+        self.save('PNG')
 
     def to_msp(self):
-        self.get_image_object().save(os.path.join(self.path, '{}.msp'.format(self.filename)))
+        self.save('MSP')
 
     def to_pcx(self):
-        self.get_image_object().save(os.path.join(self.path, '{}.pcx'.format(self.filename)))
+        self.save('PCX')
 
     def to_ppm(self):
-        self.get_image_object().save(os.path.join(self.path, '{}.ppm'.format(self.filename)))
+        self.save('PPM')
 
     def to_sgi(self):
-        self.get_image_object().save(os.path.join(self.path, '{}.sgi'.format(self.filename)))
+        self.save('SGI')
 
     def to_tiff(self):
-        self.get_image_object().save(os.path.join(self.path, '{}.tiff'.format(self.filename)))
+        self.save('TIFF')
 
     def to_webp(self):
-        self.get_image_object().save(os.path.join(self.path, '{}.webp'.format(self.filename)))
+        self.save('WEBP')
 
     def to_xbm(self):
-        self.get_image_object().save(os.path.join(self.path, '{}.xbm'.format(self.filename)))
+        self.save('XBM')
 
     def to_ico(self):
-        self.get_image_object().save(os.path.join(self.path, '{}.ico'.format(self.filename)))
+        self.save('ICO')
 
 
 class AudioConverter(object):
-
-    def __init__(self, path, filename):
+    version = 1
+    encoder_options = {'MP3': {'acodec': 'libmp3lame', 'format': 'mp3'},
+                       'WAV': {'acodec': 'pcm_s16le', 'format': 'wav'},
+                       'OGG': {'acodec': 'libvorbis', 'format': 'ogg'},
+                       'OPUS': {'acodec': 'libopus', 'format': 'opus'},
+                       'FLAC': {'acodec': 'flac', 'format': 'flac'}}
+
+    def __init__(self, path, filename, digest=None, engine=AUDIO_ENGINE, progress=None):
         self.convertations = {'MP3': self.to_mp3, 'WAV': self.to_wav, 'OGG': self.to_ogg, 'OPUS': self.to_opus,
                               'FLAC': self.to_flac}
         self.path = path
         self.file_suffix = Path(filename).suffix
         self.filename = filename[:filename.rfind(Path(filename).suffix)]
         self.original_file = os.path.join(path, filename)
+        self.digest = digest
+        self.engine = engine
+        self.progress = progress
+        self.stats = None
 
     def get_audio_object(self):
         audio = AudioSegment.from_file(self.original_file)
         return audio
 
+    def get_stream_object(self):
+        return ffmpeg.input(self.original_file).audio
+
     def convert(self, new_format):
         try:
             if self.original_file == os.path.join(self.path, '{}.{}'.format(self.filename, new_format.lower())):
                 self.filename = '{}{}'.format(uuid.uuid4().hex, self.filename)
             func = self.convertations.get(new_format)
-            func()
+            started = time.monotonic()
+            self.stats = {'engine': 'cache', 'peak_memory': 0}
+            new_file_path = cached_conversion(self, new_format, func)
+            self.stats['wall_time'] = time.monotonic() - started
             os.remove(self.original_file)
-            return {'old_file_path': self.original_file,
-                    'new_file_path': os.path.join(self.path, '{}.{}'.format(self.filename, new_format.lower()))}
+            return {'old_file_path': self.original_file, 'new_file_path': new_file_path, 'stats': self.stats}
         except Exception as e:
             return e
 
+    def transcode(self, new_format):
+        new_file_path = os.path.join(self.path, '{}.{}'.format(self.filename, new_format.lower()))
+        if self.engine == 'pydub':
+            self.get_audio_object().export(new_file_path, format=new_format.lower())
+            self.stats = {'engine': 'pydub', 'peak_memory': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                                                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+                          * 1024}
+        else:
+            # ffmpeg decodes and encodes chunk by chunk, so memory stays flat whatever the track length
+            self.stats = run_measured(self.get_stream_object().output(new_file_path,
+                                                                      **self.encoder_options[new_format]),
+                                      self.progress_report())
+
+    def progress_report(self):
+        return ProgressReport(self.progress, self.original_file) if self.progress is not None else None
+
     def to_mp3(self):
-        self.get_audio_object().export(os.path.join(self.path, '{}.mp3'.format(self.filename)), format='mp3')
+        self.transcode('MP3')
 
     def to_wav(self):
-        self.get_audio_object().export(os.path.join(self.path, '{}.wav'.format(self.filename)), format='wav')
+        self.transcode('WAV')
 
     def to_ogg(self):
-        self.get_audio_object().export(os.path.join(self.path, '{}.ogg'.format(self.filename)), format='ogg')
+        self.transcode('OGG')
 
     def to_opus(self):
-        self.get_audio_object().export(os.path.join(self.path, '{}.opus'.format(self.filename)), format='opus')
+        self.transcode('OPUS')
 
     def to_flac(self):
-        self.get_audio_object().export(os.path.join(self.path, '{}.flac'.format(self.filename)), format='flac')
+        self.transcode('FLAC')
 
 
 class VideoConverter(object):
+    version = 1
+    encoder_options = {'FLV': {'c:v': 'libx264', 'crf': '28', 'ar': '22050'}}
 
-    def __init__(self, path, filename):
+    def __init__(self, path, filename, digest=None, progress=None):
         self.convertations = {'AVI': self.to_avi, 'GIF': self.to_gif, 'OGG': self.to_ogg,
                               'MP4': self.to_mp4, 'MKV': self.to_mkv, 'FLV': self.to_flv}
         self.path = path
         self.file_suffix = Path(filename).suffix
         self.filename = filename[:filename.rfind(Path(filename).suffix)]
         self.original_file = os.path.join(path, filename)
+        self.digest = digest
+        self.progress = progress
+        self.method = None
 
     def get_stream_object(self):
         stream = ffmpeg.input(self.original_file)
@@ -139,13 +458,50 @@ class VideoConverter(object):
             if self.original_file == os.path.join(self.path, '{}.{}'.format(self.filename, new_format.lower())):
                 self.filename = '{}{}'.format(uuid.uuid4().hex, self.filename)
             func = self.convertations.get(new_format)
-            ffmpeg.run(func())
+            self.method = 'cache'
+            new_file_path = cached_conversion(self, new_format, lambda: self.run(new_format, func))
             os.remove(self.original_file)
-            return {'old_file_path': self.original_file,
-                    'new_file_path': os.path.join(self.path, '{}.{}'.format(self.filename, new_format.lower()))}
+            return {'old_file_path': self.original_file, 'new_file_path': new_file_path, 'method': self.method}
         except Exception as e:
             return e
 
+    def run(self, new_format, func):
+        progress = self.progress_report()
+        if self.can_remux(new_format):
+            try:
+                run_measured(self.remux(new_format), progress)
+                self.method = 'remux'
+                return
+            except ffmpeg.Error:
+                pass
+        run_measured(func(), progress)
+        self.method = 'transcode'
+
+    def progress_report(self):
+        return ProgressReport(self.progress, self.original_file) if self.progress is not None else None
+
+    def probe_codecs(self):
+        streams = ffmpeg.probe(self.original_file).get('streams', list())
+        return [(stream['codec_type'], stream.get('codec_name')) for stream in streams
+                if stream.get('codec_type') in ('video', 'audio')
+                and not stream.get('disposition', dict()).get('attached_pic')]
+
+    def can_remux(self, new_format):
+        allowed = REMUX_CODECS.get(new_format)
+        if allowed is None:
+            return False
+        try:
+            codecs = self.probe_codecs()
+        except Exception:
+            return False
+        return bool(codecs) and all(codec in allowed[kind] for kind, codec in codecs)
+
+    def remux(self, new_format):
+        # Stream copy only rewrites the container, the encoded packets are left untouched
+        return ffmpeg.output(self.get_stream_object(),
+                             os.path.join(self.path, '{}.{}'.format(self.filename, new_format.lower())),
+                             c='copy', sn=None)
+
     def to_avi(self):
         return ffmpeg.output(self.get_stream_object(), os.path.join(self.path, '{}.avi'.format(self.filename)))
 
@@ -163,31 +519,70 @@ class VideoConverter(object):
 
     def to_flv(self):
         return ffmpeg.output(self.get_stream_object(), os.path.join(self.path, '{}.flv'.format(self.filename)),
-                             **{'c:v': 'libx264', 'crf': '28', 'ar': '22050'})
+                             **self.encoder_options['FLV'])
 
 
 class Converter(object):
 
-    def __init__(self, path, filename, new_format):
+    def __init__(self, path, filename, new_format, digest=None):
         self.path = path
         self.filename = filename
         self.new_format = new_format
+        self.digest = digest
+        self.converter_name = None
 
     def convert(self):
         converter = None
         errors = list()
         if self.new_format.upper() in AUDIO_SUPPORTED_FORMATS:
-            converter = AudioConverter(self.path, self.filename)
+            converter = AudioConverter(self.path, self.filename, self.digest)
         elif self.new_format.upper() in VIDEO_SUPPORTED_FORMATS:
-            converter = VideoConverter(self.path, self.filename)
+            converter = VideoConverter(self.path, self.filename, self.digest)
         elif self.new_format.upper() in PICTURE_SUPPORTED_FORMATS:
-            converter = PictureConverter(self.path, self.filename)
+            converter = PictureConverter(self.path, self.filename, self.digest)
         if converter is not None:
+            self.converter_name = type(converter).__name__
             result = converter.convert(self.new_format)
             if not isinstance(result, dict):
                 errors.append(result)
         return errors
 
 
+def convert_member(path, filename, new_format):
+    # Exceptions are turned into strings so that they always survive the trip back from a pool worker
+    started = time.monotonic()
+    converter = Converter(path, filename, new_format)
+    errors = converter.convert()
+    return {'errors': ['{}: {}'.format(type(e).__name__, e) for e in errors], 'elapsed': time.monotonic() - started,
+            'converter': converter.converter_name, 'error_types': [type(e).__name__ for e in errors]}
+
+
+def convert_files(members, max_workers=None):
+    errors = dict()
+    if not members:
+        return errors
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(convert_member, path, filename, new_format): os.path.join(path, filename)
+                   for path, filename, new_format in members}
+        new_formats = {os.path.join(path, filename): new_format for path, filename, new_format in members}
+        for future in as_completed(futures):
+            result = conversion_errors(future, new_formats[futures[future]])
+            if result:
+                errors[futures[future]] = result
+    return errors
+
+
+def conversion_errors(future, new_format):
+    try:
+        result = future.result()
+    except Exception as e:
+        result = {'errors': ['{}: {}'.format(type(e).__name__, e)], 'error_types': [type(e).__name__]}
+    if result.get('converter') is not None:
+        CONVERSION_SECONDS.observe(result['elapsed'], converter=result['converter'], format=new_format)
+    for error_type in result['error_types']:
+        ERRORS.inc(type=error_type)
+    return result['errors']
+
+
 if __name__ == '__main__':
     pass
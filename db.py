@@ -1,12 +1,33 @@
+import fcntl
 import os
-from datetime import datetime
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
 import shutil
 
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Engine
 from werkzeug.security import check_password_hash, generate_password_hash
 
-PATH_TO_FILES = 'files'
+from storage import STORAGE
+from metrics import SWEEPER_RUNS, SWEEPER_DELETED, SWEEPER_LAST_DURATION, SWEEPER_LAST_RUN
+
+PATH_TO_FILES = STORAGE.root
+TRASH_FOLDER = os.path.join(PATH_TO_FILES, '.trash')
+SWEEPER_LOCK_FILE = os.path.join(PATH_TO_FILES, '.sweeper.lock')
+DELETE_BATCH_SIZE = 500
+
+sweeper_lock = None
+trash_lock = threading.Lock()
+pending_activity = dict()
+activity_lock = threading.Lock()
+user_cache = dict()
+user_cache_lock = threading.Lock()
+USER_CACHE_MAX_SIZE = 1000
 
 db = SQLAlchemy()
 
@@ -32,38 +53,275 @@ class User(UserMixin, db.Model):
 class Operation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_operation_id = db.Column(db.String(1000), index=True, nullable=False, unique=True)
-    timestamp = db.Column(db.DateTime, nullable=True, default=datetime.utcnow())
+    timestamp = db.Column(db.DateTime, index=True, nullable=True, default=datetime.utcnow)
 
     def __repr__(self):
         return '<Operation {} {}>'.format(self.user_operation_id, self.timestamp)
 
 
+class Job(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    user_operation_id = db.Column(db.String(1000), index=True, nullable=False)
+    kind = db.Column(db.String(10), nullable=False)
+    path = db.Column(db.String(1000), nullable=False)
+    filename = db.Column(db.String(1000), nullable=False)
+    new_format = db.Column(db.String(10), nullable=False)
+    digest = db.Column(db.String(64), nullable=True)
+    status = db.Column(db.String(10), index=True, nullable=False, default='queued')
+    client = db.Column(db.String(1100), index=True, nullable=True)
+    owner = db.Column(db.String(300), nullable=True)
+    result = db.Column(db.String(1000), nullable=True)
+    method = db.Column(db.String(10), nullable=True)
+    error = db.Column(db.String(1000), nullable=True)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<Job {} {} {}>'.format(self.id, self.kind, self.status)
+
+
+class Upload(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    user_operation_id = db.Column(db.String(1000), index=True, nullable=False)
+    filename = db.Column(db.String(1000), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<Upload {} {} {}>'.format(self.id, self.filename, self.size)
+
+
 def update_session(*args):
-    for el in args:
-        db.session.add(el)
-    db.session.commit()
+    try:
+        for el in args:
+            db.session.add(el)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def configure_sqlite(app):
+    pragmas = [('journal_mode', app.config.get('SQLITE_JOURNAL_MODE')),
+               ('busy_timeout', app.config.get('SQLITE_BUSY_TIMEOUT')),
+               ('synchronous', app.config.get('SQLITE_SYNCHRONOUS'))]
+
+    @event.listens_for(Engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            if value is not None:
+                cursor.execute('PRAGMA {} = {}'.format(name, value))
+        cursor.close()
+
+
+def cached_user(user_id, ttl):
+    # Users are detached from the session before caching, so they can be shared between requests
+    now = time.monotonic()
+    with user_cache_lock:
+        entry = user_cache.get(user_id)
+    if entry is not None and entry[0] > now:
+        return entry[1]
+    user = User.query.get(user_id)
+    if user is not None:
+        db.session.expunge(user)
+    with user_cache_lock:
+        if len(user_cache) >= USER_CACHE_MAX_SIZE:
+            for key in [key for key, (expires, _) in user_cache.items() if expires <= now]:
+                del user_cache[key]
+        user_cache[user_id] = (now + ttl, user)
+    return user
+
+
+def forget_user(user_id):
+    with user_cache_lock:
+        user_cache.pop(user_id, None)
+
+
+def ensure_schema():
+    # create_all skips tables that already exist, so columns and indexes added later have to be created explicitly
+    for table in (Operation.__table__, Job.__table__):
+        existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                db.session.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table.name, column.name, column.type.compile(db.engine.dialect))))
+        db.session.commit()
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+
+
+def acquire_sweeper_lock():
+    # Every web worker schedules the job, but only the process holding this lock actually sweeps
+    global sweeper_lock
+    if sweeper_lock is not None:
+        return True
+    lock = open(SWEEPER_LOCK_FILE, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return False
+    sweeper_lock = lock
+    return True
 
 
 def job_delete_inactive():
-    ops = Operation.query.all()
-    for op in ops:
-        last_activity = op.timestamp
-        uoid = op.user_operation_id
-        if float(datetime.timestamp(datetime.utcnow())) - float(datetime.timestamp(last_activity)) > 10800:
-            delete_folder(uoid)
-            db.session.delete(op)
-            update_session()
+    if not acquire_sweeper_lock():
+        return
+    started = time.monotonic()
+    flush_activity()
+    cutoff = datetime.utcnow() - timedelta(seconds=db.get_app().config.get('OPERATION_TTL', 10800))
+    expired = db.session.query(Operation.id, Operation.user_operation_id).filter(Operation.timestamp < cutoff).all()
+    deleted = delete_operations(expired, cutoff)
+    SWEEPER_DELETED.inc(deleted, reason='expired')
+    budget = db.get_app().config.get('FILES_DISK_BUDGET')
+    if budget is not None:
+        # Activity buffered in other workers is at most one flush interval old, the grace period covers it
+        grace = datetime.utcnow() - timedelta(seconds=2 * db.get_app().config.get('ACTIVITY_FLUSH_INTERVAL', 30))
+        SWEEPER_DELETED.inc(evict_to_budget(budget, grace), reason='budget')
+    SWEEPER_DELETED.inc(purge_spool(time.time() - db.get_app().config.get('UPLOAD_SPOOL_TTL', 3600)), reason='spool')
+    empty_trash_in_background()
+    SWEEPER_RUNS.inc()
+    SWEEPER_LAST_DURATION.set(time.monotonic() - started)
+    SWEEPER_LAST_RUN.set(time.time())
+
+
+def delete_operations(rows, since):
+    # Activity is checked again right before the delete, the rows may have been picked a while ago
+    rows = [row for row in rows if not recently_active(row.user_operation_id, since)]
+    if not rows:
+        return 0
+    ids = [row.id for row in rows]
+    names = [row.user_operation_id for row in rows]
+    # The jobs and uploads of an operation point into its folder, they go in the same transaction
+    for start in range(0, len(ids), DELETE_BATCH_SIZE):
+        Operation.query.filter(Operation.id.in_(ids[start:start + DELETE_BATCH_SIZE])) \
+            .delete(synchronize_session=False)
+        for model in (Job, Upload):
+            model.query.filter(model.user_operation_id.in_(names[start:start + DELETE_BATCH_SIZE])) \
+                .delete(synchronize_session=False)
+    db.session.commit()
+    for row in rows:
+        discard_folder(row.user_operation_id)
+    return len(rows)
+
+
+def purge_spool(cutoff):
+    # Spool files normally go away with their request; this catches those of a process that died mid-upload
+    deleted = 0
+    directory = STORAGE.spool_directory()
+    for name in os.listdir(directory) if os.path.isdir(directory) else ():
+        try:
+            if os.path.getmtime(os.path.join(directory, name)) < cutoff:
+                os.remove(os.path.join(directory, name))
+                deleted += 1
+        except FileNotFoundError:
+            pass
+    return deleted
+
+
+def evict_to_budget(budget, grace):
+    usage = folder_size(PATH_TO_FILES, exclude=(os.path.basename(TRASH_FOLDER),))
+    if usage <= budget:
+        return 0
+    victims = list()
+    for row in db.session.query(Operation.id, Operation.user_operation_id).order_by(Operation.timestamp).yield_per(100):
+        if usage <= budget:
+            break
+        if recently_active(row.user_operation_id, grace):
+            continue
+        usage -= folder_size(STORAGE.folder(row.user_operation_id))
+        victims.append(row)
+    return delete_operations(victims, grace)
+
+
+def recently_active(name, since):
+    # to_db touches the operation folder, so its mtime is never older than a buffered heartbeat
+    try:
+        return datetime.utcfromtimestamp(os.path.getmtime(STORAGE.folder(name))) >= since
+    except FileNotFoundError:
+        return False
+
+
+def folder_size(path, exclude=()):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        if root == path:
+            dirs[:] = [name for name in dirs if name not in exclude]
+        for file in files:
+            try:
+                total += os.lstat(os.path.join(root, file)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def discard_folder(name):
+    # Renaming is instant; the slow recursive delete happens later in the trash cleanup thread
+    os.makedirs(TRASH_FOLDER, exist_ok=True)
+    try:
+        os.replace(STORAGE.folder(name), os.path.join(TRASH_FOLDER, '{}-{}'.format(name, uuid.uuid4().hex)))
+    except FileNotFoundError:
+        pass
+    STORAGE.forget(name)
+
+
+def empty_trash():
+    if not trash_lock.acquire(blocking=False):
+        return
+    try:
+        for name in os.listdir(TRASH_FOLDER):
+            shutil.rmtree(os.path.join(TRASH_FOLDER, name), ignore_errors=True)
+    finally:
+        trash_lock.release()
+
+
+def empty_trash_in_background():
+    if os.path.isdir(TRASH_FOLDER) and os.listdir(TRASH_FOLDER):
+        threading.Thread(target=empty_trash, daemon=True).start()
 
 
 def delete_folder(name):
-    path = os.path.join(PATH_TO_FILES, name)
+    path = STORAGE.folder(name)
     if os.path.exists(path):
-        shutil.rmtree(os.path.join(PATH_TO_FILES, name))
+        shutil.rmtree(path)
 
 
 def to_db(name):
-    op = Operation.query.filter_by(user_operation_id=name).first()
-    if op is None:
-        op = Operation(user_operation_id=name)
-    op.timestamp = datetime.utcnow()
-    update_session(op)
+    # Only recorded in memory here, flush_activity writes all buffered heartbeats in one transaction.
+    # The folder's mtime is what the sweeper sees of a heartbeat still buffered in another worker
+    with activity_lock:
+        pending_activity[name] = datetime.utcnow()
+    try:
+        os.utime(STORAGE.folder(name))
+    except FileNotFoundError:
+        pass
+
+
+def flush_activity():
+    with activity_lock:
+        pending = dict(pending_activity)
+        pending_activity.clear()
+    if not pending:
+        return
+    try:
+        names = list(pending)
+        ops = dict()
+        for start in range(0, len(names), DELETE_BATCH_SIZE):
+            for op in Operation.query.filter(Operation.user_operation_id.in_(names[start:start + DELETE_BATCH_SIZE])):
+                ops[op.user_operation_id] = op
+        for name, timestamp in pending.items():
+            op = ops.get(name)
+            if op is None:
+                op = Operation(user_operation_id=name)
+                db.session.add(op)
+            op.timestamp = timestamp if op.timestamp is None else max(op.timestamp, timestamp)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        with activity_lock:
+            for name, timestamp in pending.items():
+                pending_activity[name] = max(pending_activity.get(name, timestamp), timestamp)
+        raise
@@ -0,0 +1,299 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import partial
+
+from admission import Admission, AdmissionError
+from convert_functions import PictureConverter, AudioConverter, VideoConverter, \
+    VIDEO_SUPPORTED_FORMATS, AUDIO_SUPPORTED_FORMATS, PICTURE_SUPPORTED_FORMATS
+from db import db, Job, update_session
+from storage import STORAGE
+from metrics import CONVERSION_SECONDS, OUTPUT_BYTES, ERRORS
+
+CONVERTERS = {'picture': PictureConverter, 'audio': AudioConverter, 'video': VideoConverter}
+JOB_QUEUED = 'queued'
+JOB_DONE = 'done'
+JOB_ERROR = 'error'
+
+
+def run_conversion(kind, path, filename, new_formats, digest=None, progress=None):
+    # Executed inside a pool worker, so everything returned here has to be picklable.
+    # Returns one result per format; every format of a picture is written from a single decode
+    started = time.monotonic()
+    if kind == 'picture':
+        results = PictureConverter(path, filename, digest).convert_many(new_formats)
+        results = [results[new_format] for new_format in new_formats]
+    else:
+        results = [CONVERTERS[kind](path, filename, digest, progress=progress).convert(new_formats[0])]
+    elapsed = time.monotonic() - started
+    for index, result in enumerate(results):
+        if isinstance(result, dict):
+            STORAGE.publish(result['new_file_path'])
+            # Pictures time each format themselves, the other converters are timed here
+            result.setdefault('elapsed', elapsed)
+        else:
+            results[index] = 'error', type(result).__name__, str(result)
+    return results
+
+
+def group(items):
+    # Pictures asked for in several formats share their upload and are converted together,
+    # every other item becomes a group of one
+    groups = dict()
+    for job_id, kind, path, filename, new_format, digest in items:
+        key = (kind, path, filename) if kind == 'picture' else job_id
+        if key in groups:
+            groups[key][0].append(job_id)
+            groups[key][4].append(new_format)
+        else:
+            groups[key] = [job_id], kind, path, filename, [new_format], digest
+    return list(groups.values())
+
+
+def progress_path(path, job_id):
+    return os.path.join(path, '.progress-{}.json'.format(job_id))
+
+
+def read_progress(job):
+    try:
+        with open(progress_path(job.path, job.id)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def job_kind(filename):
+    # Picks the converter from the source file, in the same order as system_function.get_file_type
+    suffix = os.path.splitext(filename)[1][1:].upper()
+    for kind, formats in (('audio', AUDIO_SUPPORTED_FORMATS), ('picture', PICTURE_SUPPORTED_FORMATS),
+                          ('video', VIDEO_SUPPORTED_FORMATS)):
+        if suffix in formats:
+            return kind
+    return None
+
+
+def owner_alive(owner, current):
+    # Owners are host:pid:boot. A restarted container often gets its old pid back, the boot id tells them apart
+    if not owner:
+        return False
+    host, pid = (owner.split(':') + [''])[:2]
+    if host != socket.gethostname():
+        return True
+    if pid == str(os.getpid()):
+        return owner == current
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        return True
+    return True
+
+
+class JobQueue(object):
+
+    def __init__(self, app=None):
+        self.app = None
+        self.executor = None
+        self.admission = Admission()
+        self.pending = deque()
+        self.running = dict()
+        self.lock = threading.RLock()
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        self.poll_interval = 1
+        self.wait = 30
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.admission.init_app(app)
+        self.start_pool()
+        with app.app_context():
+            self.recover()
+        self.poll_interval = app.config.get('ADMISSION_POLL_INTERVAL', 1)
+        self.wait = app.config.get('ADMISSION_WAIT', 30)
+        threading.Thread(target=self.poll, daemon=True).start()
+
+    def start_pool(self, broken=None):
+        # A killed worker (the OOM killer, usually) breaks the whole pool and every later submit would fail,
+        # so a broken pool is replaced once, by whoever notices first
+        with self.lock:
+            if broken is not None and self.executor is not broken:
+                return
+            if broken is not None:
+                broken.shutdown(wait=False)
+            self.executor = ProcessPoolExecutor(max_workers=self.admission.slots)
+
+    def poll(self):
+        # Slots freed by other processes are not announced, waiting jobs retry on a timer
+        while True:
+            time.sleep(self.poll_interval)
+            if self.pending:
+                self.dispatch()
+
+    def depth(self):
+        return Job.query.filter_by(status=JOB_QUEUED).count()
+
+    def active(self, client):
+        return Job.query.filter_by(status=JOB_QUEUED, client=client).count()
+
+    def position(self, job):
+        return Job.query.filter(Job.status == JOB_QUEUED, Job.created < job.created).count()
+
+    def admit(self, client, count=1):
+        self.admission.admit(self.depth(), self.active(client), client, count)
+
+    @contextmanager
+    def reserve(self, kind, path, filename, new_format, operation_id, client, workers):
+        # Work done inside the request (archive conversions) is held to the same quotas and machine-wide slots as
+        # queued jobs: a queued row counts it for the client while it runs, and it takes as many free slots
+        # as it may use workers, starting once it has at least one
+        self.admit(client)
+        job = Job(id=uuid.uuid4().hex, user_operation_id=operation_id, kind=kind, path=path, filename=filename,
+                  new_format=new_format, status=JOB_QUEUED, client=client, owner=self.owner)
+        update_session(job)
+        tokens = list()
+        status, error = JOB_ERROR, None
+        deadline = time.monotonic() + self.wait
+        try:
+            while True:
+                while len(tokens) < workers:
+                    token = uuid.uuid4().hex
+                    if not self.admission.acquire(token, kind):
+                        break
+                    tokens.append(token)
+                if tokens:
+                    break
+                if time.monotonic() >= deadline:
+                    raise AdmissionError('Sorry, the server is busy right now. Try again later', 503,
+                                         self.admission.retry_after)
+                time.sleep(self.poll_interval)
+            yield len(tokens)
+            status = JOB_DONE
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+            raise
+        finally:
+            for token in tokens:
+                self.admission.release(token)
+            self.dispatch()
+            Job.query.filter_by(id=job.id).update({'status': status, 'error': error})
+            db.session.commit()
+
+    def enqueue(self, kind, path, filename, new_format, operation_id, digest=None, client=None):
+        return self.enqueue_many([(kind, path, filename, new_format, digest)], operation_id, client)[0]
+
+    def enqueue_many(self, items, operation_id, client=None):
+        # One admission check and one commit for the whole batch, then every item is handed to the dispatcher
+        client = client or 'session:{}'.format(operation_id)
+        self.admit(client, len(items))
+        ids = [uuid.uuid4().hex for _ in items]
+        update_session(*[Job(id=job_id, user_operation_id=operation_id, kind=kind, path=path, filename=filename,
+                             new_format=new_format, digest=digest, status=JOB_QUEUED, client=client,
+                             owner=self.owner)
+                         for job_id, (kind, path, filename, new_format, digest) in zip(ids, items)])
+        for job_ids, kind, path, filename, new_formats, digest in group(
+                [(job_id,) + tuple(item) for job_id, item in zip(ids, items)]):
+            self.submit(job_ids, kind, path, filename, new_formats, digest)
+        return ids
+
+    def submit(self, job_ids, kind, path, filename, new_formats, digest=None):
+        with self.lock:
+            self.pending.append((job_ids, kind, path, filename, new_formats, digest))
+        self.dispatch()
+
+    def dispatch(self):
+        # Jobs wait here rather than in the pool so that the memory budget is checked before ffmpeg starts
+        with self.lock:
+            while self.pending and self.admission.acquire(self.pending[0][0][0], self.pending[0][1]):
+                job_ids, kind, path, filename, new_formats, digest = self.pending.popleft()
+                self.running[job_ids[0]] = kind
+                try:
+                    executor, future = self.submit_to_pool(job_ids, kind, path, filename, new_formats, digest)
+                except Exception:
+                    # The slot is only kept by a job that reached the pool; the job waits for the next dispatch
+                    self.running.pop(job_ids[0], None)
+                    self.admission.release(job_ids[0])
+                    self.pending.appendleft((job_ids, kind, path, filename, new_formats, digest))
+                    raise
+                future.add_done_callback(partial(self.finish, job_ids, executor))
+
+    def submit_to_pool(self, job_ids, kind, path, filename, new_formats, digest):
+        executor = self.executor
+        try:
+            return executor, executor.submit(run_conversion, kind, path, filename, new_formats, digest,
+                                             progress_path(path, job_ids[0]))
+        except BrokenProcessPool:
+            self.start_pool(executor)
+            executor = self.executor
+            return executor, executor.submit(run_conversion, kind, path, filename, new_formats, digest,
+                                             progress_path(path, job_ids[0]))
+
+    def finish(self, job_ids, executor, future):
+        if isinstance(future.exception(), BrokenProcessPool):
+            # The jobs that were running in the pool fail with it, the ones still pending go to the new pool
+            self.start_pool(executor)
+        with self.lock:
+            self.running.pop(job_ids[0], None)
+        self.admission.release(job_ids[0])
+        self.dispatch()
+        try:
+            results = future.result()
+        except Exception as e:
+            results = [('error', type(e).__name__, str(e))] * len(job_ids)
+        with self.app.app_context():
+            finished = list()
+            for job_id, result in zip(job_ids, results):
+                job = Job.query.get(job_id)
+                if job is None:
+                    continue
+                converter = CONVERTERS[job.kind].__name__
+                if isinstance(result, dict):
+                    job.status = JOB_DONE
+                    job.result = result['new_file_path']
+                    # How a video was produced (remux, transcode or cache); other converters leave it empty
+                    job.method = result.get('method')
+                    CONVERSION_SECONDS.observe(result['elapsed'], converter=converter, format=job.new_format)
+                    if os.path.exists(job.result):
+                        OUTPUT_BYTES.inc(os.path.getsize(job.result), converter=converter)
+                else:
+                    job.status = JOB_ERROR
+                    job.error = '{}: {}'.format(result[1], result[2])
+                    ERRORS.inc(type=result[1])
+                finished.append(job)
+            update_session(*finished)
+
+    def recover(self):
+        # Picks up work that was queued by a process which is no longer running
+        claimed = list()
+        for job in Job.query.filter_by(status=JOB_QUEUED).order_by(Job.created).all():
+            if owner_alive(job.owner, self.owner):
+                continue
+            if job.kind not in CONVERTERS:
+                # Conversions done inside a request died with their process, there is nothing to resubmit
+                Job.query.filter_by(id=job.id, owner=job.owner).update(
+                    {'status': JOB_ERROR, 'error': 'The process running the conversion stopped'})
+                db.session.commit()
+                continue
+            if Job.query.filter_by(id=job.id, owner=job.owner).update({'owner': self.owner}):
+                claimed.append((job.id, job.kind, job.path, job.filename, job.new_format, job.digest))
+            db.session.commit()
+        for item in group(claimed):
+            self.submit(*item)
+
+    def batch(self, operation_id):
+        return Job.query.filter_by(user_operation_id=operation_id).order_by(Job.created, Job.filename).all()
+
+    def get(self, job_id, operation_id):
+        job = Job.query.get(job_id)
+        if job is None or job.user_operation_id != operation_id:
+            return None
+        return job
@@ -0,0 +1,95 @@
+import queue
+import threading
+import time
+
+
+class LocalConnection(object):
+
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+
+    def __enter__(self):
+        self.mailbox.connections += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def send(self, message):
+        if self.mailbox.delay:
+            time.sleep(self.mailbox.delay)
+        self.mailbox.outbox.append(message)
+
+
+class LocalMailbox(object):
+    """Stand-in for the SMTP server: keeps delivered messages in memory, optionally simulating a slow server."""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.outbox = list()
+        self.connections = 0
+
+    def connect(self):
+        return LocalConnection(self)
+
+
+class MailQueue(object):
+
+    def __init__(self, app=None, mail=None):
+        self.app = None
+        self.backend = None
+        self.messages = queue.Queue()
+        if app is not None:
+            self.init_app(app, mail)
+
+    def init_app(self, app, mail):
+        self.app = app
+        if app.config.get('MAIL_BACKEND') == 'local':
+            self.backend = LocalMailbox(app.config.get('MAIL_LOCAL_DELAY', 0))
+        else:
+            self.backend = mail
+        self.batch_size = app.config.get('MAIL_BATCH_SIZE', 20)
+        self.retries = app.config.get('MAIL_RETRIES', 5)
+        self.backoff = app.config.get('MAIL_RETRY_BACKOFF', 2)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def send(self, message):
+        self.messages.put((message, 0))
+
+    def run(self):
+        while True:
+            batch = [self.messages.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.messages.get_nowait())
+                except queue.Empty:
+                    break
+            self.deliver(batch)
+
+    def deliver(self, batch):
+        # One SMTP connection is reused for the whole batch
+        connected = False
+        with self.app.app_context():
+            try:
+                with self.backend.connect() as connection:
+                    connected = True
+                    while batch:
+                        connection.send(batch[0][0])
+                        batch.pop(0)
+            except Exception:
+                self.app.logger.exception('Mail delivery failed')
+                if connected:
+                    self.retry(*batch.pop(0))
+                    for item in batch:
+                        self.messages.put(item)
+                else:
+                    for item in batch:
+                        self.retry(*item)
+
+    def retry(self, message, attempt):
+        if attempt + 1 >= self.retries:
+            self.app.logger.error('Giving up on mail to %s', ', '.join(message.recipients))
+            return
+        timer = threading.Timer(self.backoff * 2 ** attempt, self.messages.put, ((message, attempt + 1),))
+        timer.daemon = True
+        timer.start()
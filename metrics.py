@@ -0,0 +1,119 @@
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                    for name, value in pairs))
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.extend(self.render_value(key, value))
+        return lines
+
+    def render_value(self, key, value):
+        return ['{}{} {}'.format(self.name, format_labels(self.labels, key), value)]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    def render_value(self, key, value):
+        counts, total = value
+        lines = list()
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(self.name, format_labels(self.labels, key, [('le', bound)]),
+                                                 cumulative))
+        lines.append('{}_sum{} {}'.format(self.name, format_labels(self.labels, key), total))
+        lines.append('{}_count{} {}'.format(self.name, format_labels(self.labels, key), cumulative))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = list()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = list()
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CONVERSION_SECONDS = REGISTRY.register(Histogram('converter_conversion_seconds', 'Conversion wall time',
+                                                 ('converter', 'format')))
+UPLOAD_BYTES = REGISTRY.register(Counter('converter_upload_bytes_total', 'Bytes received in uploads'))
+OUTPUT_BYTES = REGISTRY.register(Counter('converter_output_bytes_total', 'Bytes written by conversions',
+                                         ('converter',)))
+DOWNLOAD_BYTES = REGISTRY.register(Counter('converter_download_bytes_total', 'Bytes sent by the download route'))
+ERRORS = REGISTRY.register(Counter('converter_errors_total', 'Errors by exception type', ('type',)))
+JOB_QUEUE_DEPTH = REGISTRY.register(Gauge('converter_job_queue_depth', 'Conversion jobs waiting or running'))
+FILES_DISK_USAGE = REGISTRY.register(Gauge('converter_files_disk_usage_bytes', 'Disk used by the files folder'))
+SWEEPER_RUNS = REGISTRY.register(Counter('converter_sweeper_runs_total', 'Sweeper runs in this process'))
+SWEEPER_DELETED = REGISTRY.register(Counter('converter_sweeper_deleted_total',
+                                            'Operations (and stale upload spool files) removed by the sweeper',
+                                            ('reason',)))
+SWEEPER_LAST_DURATION = REGISTRY.register(Gauge('converter_sweeper_last_duration_seconds',
+                                                'Duration of the last sweeper run'))
+SWEEPER_LAST_RUN = REGISTRY.register(Gauge('converter_sweeper_last_run_timestamp_seconds',
+                                           'Unix time of the last sweeper run'))
@@ -0,0 +1,150 @@
+import cProfile
+import hmac
+import json
+import os
+import random
+import time
+import uuid
+
+from flask import g, request, has_request_context, before_render_template, template_rendered
+
+
+class NullPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_PHASE = NullPhase()
+
+
+class Phase(object):
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.add(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class RequestProfile(object):
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.started = time.perf_counter()
+        self.phases = dict()
+        self.rendering = None
+        self.profiler = cProfile.Profile()
+        try:
+            self.profiler.enable()
+        except ValueError:
+            # Only one cProfile profiler may run at a time, concurrent requests keep the phase breakdown only
+            self.profiler = None
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+        return time.perf_counter() - self.started
+
+
+class Profiler(object):
+    """Profiles a sampled fraction of requests, or the ones sending the profile secret, into PROFILE_DIRECTORY."""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # Nothing is hooked into the app unless profiling is switched on, so the disabled cost is a single check
+        self.enabled = app.config.get('PROFILE_ENABLED', False)
+        if not self.enabled:
+            return
+        self.sample_rate = app.config.get('PROFILE_SAMPLE_RATE', 0.0)
+        self.header = app.config.get('PROFILE_HEADER', 'X-Profile')
+        self.secret = app.config.get('PROFILE_SECRET')
+        self.directory = app.config.get('PROFILE_DIRECTORY', 'profiles/')
+        os.makedirs(self.directory, exist_ok=True)
+        app.before_request_funcs.setdefault(None, []).insert(0, self.start)
+        app.after_request(self.finish)
+        app.teardown_request(self.discard)
+        before_render_template.connect(self.render_started, app)
+        template_rendered.connect(self.render_finished, app)
+
+    def current(self):
+        if not self.enabled or not has_request_context():
+            return None
+        return g.get('request_profile')
+
+    def phase(self, name):
+        profile = self.current()
+        if profile is None:
+            return NULL_PHASE
+        return Phase(profile, name)
+
+    def requested(self):
+        # Profiling a request is expensive, so only someone who knows the secret may ask for it
+        value = request.headers.get(self.header)
+        return bool(self.secret) and value is not None and hmac.compare_digest(value.encode(), self.secret.encode())
+
+    def start(self):
+        if not self.requested() and random.random() >= self.sample_rate:
+            return
+        g.request_profile = RequestProfile()
+        with Phase(g.request_profile, 'parse'):
+            # Form parsing is lazy; forcing it here attributes the multipart spooling to its own phase
+            request.form
+            request.files
+
+    def render_started(self, sender, template, context, **extra):
+        profile = self.current()
+        if profile is not None:
+            profile.rendering = time.perf_counter()
+
+    def render_finished(self, sender, template, context, **extra):
+        profile = self.current()
+        if profile is not None and profile.rendering is not None:
+            profile.add('render', time.perf_counter() - profile.rendering)
+            profile.rendering = None
+
+    def finish(self, response):
+        profile = g.pop('request_profile', None)
+        if profile is None:
+            return response
+        total = profile.stop()
+        name = '{}-{}-{}'.format(time.strftime('%Y%m%d%H%M%S'), request.endpoint or 'unknown', profile.id)
+        if profile.profiler is not None:
+            profile.profiler.dump_stats(os.path.join(self.directory, name + '.prof'))
+        report = {'id': profile.id, 'method': request.method, 'path': request.path, 'endpoint': request.endpoint,
+                  'status': response.status_code, 'total': total, 'cprofile': profile.profiler is not None,
+                  'phases': dict(profile.phases, other=max(total - sum(profile.phases.values()), 0))}
+        with open(os.path.join(self.directory, name + '.json'), 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+        response.headers['X-Profile-Id'] = profile.id
+        return response
+
+    def discard(self, exception):
+        # A request that failed before after_request still has to release the profiler
+        profile = g.pop('request_profile', None)
+        if profile is not None:
+            profile.stop()
+
+
+PROFILER = Profiler()
+
+
+def phase(name):
+    return PROFILER.phase(name)
@@ -0,0 +1,100 @@
+(function () {
+    // Large files are sent in resumable chunks; small ones keep the plain multipart form post
+    function request(method, url, body, headers) {
+        return fetch(url, {method: method, body: body, headers: headers || {}, credentials: "same-origin"});
+    }
+
+    function json(response) {
+        return response.json().then(function (data) {
+            data.httpStatus = response.status;
+            return data;
+        });
+    }
+
+    function wait(ms) {
+        return new Promise(function (resolve) { setTimeout(resolve, ms); });
+    }
+
+    function start(form, file, key) {
+        var saved = localStorage.getItem(key);
+        if (saved) {
+            return request("GET", saved).then(json).then(function (upload) {
+                return upload.httpStatus === 200 ? upload : create(form, file, key);
+            });
+        }
+        return create(form, file, key);
+    }
+
+    function create(form, file, key) {
+        return request("POST", form.dataset.uploadUrl, JSON.stringify({filename: file.name, size: file.size}),
+            {"Content-Type": "application/json"}).then(json).then(function (upload) {
+            if (upload.httpStatus !== 201) {
+                throw new Error(upload.error);
+            }
+            localStorage.setItem(key, upload.url);
+            return upload;
+        });
+    }
+
+    function send(form, file, upload, button, failures) {
+        if (upload.offset >= upload.size) {
+            return Promise.resolve(upload);
+        }
+        var chunkSize = parseInt(form.dataset.chunkSize, 10);
+        var chunk = file.slice(upload.offset, upload.offset + chunkSize);
+        return request("PATCH", upload.url, chunk, {
+            "Content-Type": "application/offset+octet-stream",
+            "Upload-Offset": String(upload.offset)
+        }).then(json).then(function (state) {
+            if (state.httpStatus !== 200 && state.httpStatus !== 409) {
+                throw new Error(state.error);
+            }
+            upload.offset = state.offset;
+            button.value = "Uploading " + Math.floor(100 * upload.offset / upload.size) + "%";
+            return send(form, file, upload, button, 0);
+        }, function () {
+            // The connection dropped: ask the server how far it got and carry on from there
+            return wait(Math.min(30000, 1000 * Math.pow(2, failures))).then(function () {
+                return request("GET", upload.url).then(json).then(function (state) {
+                    upload.offset = state.offset;
+                    return send(form, file, upload, button, failures + 1);
+                }, function () {
+                    return send(form, file, upload, button, failures + 1);
+                });
+            });
+        });
+    }
+
+    document.querySelectorAll("form[data-upload-target]").forEach(function (form) {
+        form.addEventListener("submit", function (event) {
+            var input = form.querySelector("input[type=file]");
+            var file = input && input.files[0];
+            if (!file || !window.fetch || file.size <= parseInt(form.dataset.chunkSize, 10)) {
+                return;
+            }
+            event.preventDefault();
+            var button = form.querySelector("input[type=submit]");
+            var format = form.querySelector("select[name=file_format]");
+            var key = ["upload", form.dataset.uploadTarget, file.name, file.size, file.lastModified].join(":");
+            button.disabled = true;
+            start(form, file, key).then(function (upload) {
+                return send(form, file, upload, button, 0);
+            }).then(function (upload) {
+                return request("POST", upload.finish_url, JSON.stringify({
+                    target: form.dataset.uploadTarget,
+                    format: format ? format.value : null
+                }), {"Content-Type": "application/json"}).then(json);
+            }).then(function (result) {
+                if (!result.redirect) {
+                    throw new Error(result.error);
+                }
+                localStorage.removeItem(key);
+                window.location.assign(result.redirect);
+            }).catch(function (error) {
+                button.disabled = false;
+                button.value = "Try again";
+                alert(error.message || "Upload failed");
+            });
+        });
+    });
+})();
@@ -0,0 +1,150 @@
+import os
+import shutil
+import uuid
+
+FILES_ROOT = 'files'
+SHARD_WIDTH = 2
+DELETE_BATCH_SIZE = 1000
+
+
+class LocalObjectStore(object):
+    """Stand-in for an S3 client that keeps objects in a directory; implements the calls Storage makes."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def object_path(self, bucket, key):
+        path = os.path.abspath(os.path.join(self.directory, bucket, key))
+        if not path.startswith(os.path.abspath(os.path.join(self.directory, bucket)) + os.sep):
+            raise ValueError('Invalid key {}'.format(key))
+        return path
+
+    def upload_file(self, Filename, Bucket, Key):
+        path = self.object_path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        shutil.copyfile(Filename, temp)
+        os.replace(temp, path)
+
+    def download_file(self, Bucket, Key, Filename):
+        shutil.copyfile(self.object_path(Bucket, Key), Filename)
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        root = os.path.join(self.directory, Bucket)
+        keys = sorted(os.path.relpath(os.path.join(folder, file), root).replace(os.sep, '/')
+                      for folder, dirs, files in os.walk(root) for file in files)
+        return {'Contents': [{'Key': key} for key in keys if key.startswith(Prefix)], 'IsTruncated': False}
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete['Objects']:
+            try:
+                os.remove(self.object_path(Bucket, item['Key']))
+            except FileNotFoundError:
+                pass
+        return {}
+
+
+class Storage(object):
+    """Operation folders in a sharded local tree, an optional scratch tier and an optional shared object store."""
+
+    def __init__(self, root=FILES_ROOT, shard_width=SHARD_WIDTH):
+        self.root = root
+        self.shard_width = shard_width
+        self.scratch = None
+        self.objects = None
+        self.bucket = None
+        self.prefix = ''
+
+    def init_app(self, app):
+        self.scratch = app.config.get('STORAGE_SCRATCH_DIRECTORY')
+        self.shard_width = app.config.get('STORAGE_SHARD_WIDTH', SHARD_WIDTH)
+        if app.config.get('STORAGE_BACKEND') == 's3':
+            self.bucket = app.config['STORAGE_S3_BUCKET']
+            self.prefix = app.config.get('STORAGE_S3_PREFIX') or ''
+            if app.config.get('STORAGE_S3_STANDIN_DIRECTORY'):
+                self.objects = LocalObjectStore(app.config['STORAGE_S3_STANDIN_DIRECTORY'])
+            else:
+                import boto3
+                self.objects = boto3.client('s3', endpoint_url=app.config.get('STORAGE_S3_ENDPOINT'))
+
+    def folder(self, name):
+        # Operation ids are random hex, so their first characters spread the folders evenly over the shards
+        sharded = os.path.join(self.root, name[:self.shard_width], name)
+        legacy = os.path.join(self.root, name)
+        if self.shard_width and not os.path.isdir(sharded) and os.path.isdir(legacy):
+            return legacy
+        return sharded
+
+    def create(self, name):
+        path = self.folder(name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def drop_scratch(self, name):
+        if self.scratch is not None:
+            shutil.rmtree(os.path.join(self.scratch, name[:self.shard_width], name), ignore_errors=True)
+
+    def spool_directory(self):
+        return os.path.join(self.scratch or self.root, '.uploads')
+
+    def scratch_dir(self, path, name):
+        # Intermediate trees live on the scratch tier and are linked into the operation folder,
+        # so every path the rest of the code builds keeps pointing inside the operation folder
+        link = self.remove_dir(path, name)
+        if self.scratch is None:
+            os.mkdir(link)
+            return link
+        target = os.path.join(self.scratch, os.path.relpath(os.path.abspath(path), os.path.abspath(self.root)), name)
+        os.makedirs(target)
+        os.symlink(os.path.abspath(target), link)
+        return link
+
+    def remove_dir(self, path, name):
+        link = os.path.join(path, name)
+        if os.path.islink(link):
+            shutil.rmtree(os.path.realpath(link), ignore_errors=True)
+            os.remove(link)
+        elif os.path.exists(link):
+            shutil.rmtree(link)
+        return link
+
+    def key(self, path):
+        return self.prefix + os.path.relpath(os.path.abspath(path), os.path.abspath(self.root)).replace(os.sep, '/')
+
+    def publish(self, path):
+        if self.objects is not None:
+            self.objects.upload_file(path, self.bucket, self.key(path))
+
+    def localize(self, path):
+        # Another node may have produced the file; fetch it from the shared store into the local tree
+        if os.path.isfile(path) or self.objects is None:
+            return os.path.isfile(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        try:
+            self.objects.download_file(self.bucket, self.key(path), temp)
+        except Exception:
+            if os.path.exists(temp):
+                os.remove(temp)
+            return False
+        os.replace(temp, path)
+        return True
+
+    def forget(self, name):
+        self.drop_scratch(name)
+        if self.objects is None:
+            return
+        listing = {'Bucket': self.bucket, 'Prefix': self.key(self.folder(name)) + '/'}
+        keys = list()
+        while True:
+            page = self.objects.list_objects_v2(**listing)
+            keys.extend(item['Key'] for item in page.get('Contents', list()))
+            if not page.get('IsTruncated'):
+                break
+            listing['ContinuationToken'] = page['NextContinuationToken']
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            self.objects.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': key} for key in keys[start:start + DELETE_BATCH_SIZE]]})
+
+
+STORAGE = Storage()
@@ -1,30 +1,36 @@
 import os
 import shutil
+import uuid
 from pathlib import Path
 
 from convert_functions import VIDEO_SUPPORTED_FORMATS, AUDIO_SUPPORTED_FORMATS, PICTURE_SUPPORTED_FORMATS
 from db import to_db
+from storage import STORAGE
 
-USER_FILES_DIRCTORY = 'files/'
+USER_FILES_DIRCTORY = STORAGE.root
 
 
 def create_folder(name):
     to_db(name)
-    if os.path.exists(os.path.join(USER_FILES_DIRCTORY, name)):
-        delete_folder(name)
-    os.mkdir(os.path.join(USER_FILES_DIRCTORY, name))
-    return os.path.join(USER_FILES_DIRCTORY, name)
+    return STORAGE.create(name)
+
+
+def create_upload_folder(name):
+    # Every upload gets its own folder, so a new upload never touches the files of a conversion still in progress
+    path = os.path.join(create_folder(name), uuid.uuid4().hex)
+    os.mkdir(path)
+    return path
 
 
 def delete_folder(name):
-    path = os.path.join(USER_FILES_DIRCTORY, name)
+    path = STORAGE.folder(name)
     if os.path.exists(path):
-        shutil.rmtree(os.path.join(USER_FILES_DIRCTORY, name))
+        shutil.rmtree(path)
 
 
 def create_files():
-    if not os.path.exists(USER_FILES_DIRCTORY):
-        os.mkdir(USER_FILES_DIRCTORY)
+    os.makedirs(USER_FILES_DIRCTORY, exist_ok=True)
+    os.makedirs(STORAGE.spool_directory(), exist_ok=True)
 
 
 def get_file_type(file):
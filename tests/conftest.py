@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import RESULT_CACHE  # noqa: E402
+from db import db  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # A bare application with its own database; jobs.JobQueue and the sweeper only need the config and the models
+    monkeypatch.setattr(RESULT_CACHE, 'enabled', False)
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///{}'.format(tmp_path / 'test.db'),
+                      SQLALCHEMY_TRACK_MODIFICATIONS=False, CONVERT_WORKERS=1, ADMISSION_POLL_INTERVAL=0.1,
+                      ADMISSION_LOCK_DIRECTORY=str(tmp_path / 'admission'))
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
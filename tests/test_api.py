@@ -0,0 +1,65 @@
+import io
+import os
+import time
+
+import pytest
+from PIL import Image
+
+from db import Job
+
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    # The application module reads Config and the working directory once, at import
+    import config
+    root = tmp_path_factory.mktemp('site')
+    cwd = os.getcwd()
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(config.Config, 'SQLALCHEMY_DATABASE_URI', 'sqlite:///{}'.format(root / 'converter.db'))
+        patch.setattr(config.Config, 'CONVERT_WORKERS', 1)
+        patch.setattr(config.Config, 'ADMISSION_LOCK_DIRECTORY', str(root / 'admission'))
+        patch.setattr(config.Config, 'CACHE_ENABLED', False)
+        os.chdir(str(root))
+        try:
+            import app
+            app.app.config['WTF_CSRF_ENABLED'] = False
+            with app.app.app_context():
+                yield app.app.test_client()
+        finally:
+            os.chdir(cwd)
+
+
+def png():
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), 'red').save(buffer, 'PNG')
+    return io.BytesIO(buffer.getvalue())
+
+
+def finished(client, response, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        report = client.get(response.headers['Location']).get_json()
+        if report['status'] != 'queued':
+            return report
+        time.sleep(0.05)
+    raise AssertionError('the batch is still queued')
+
+
+@pytest.mark.parametrize('value', ['webp', 'Jpeg', ' png , Webp'])
+def test_batch_formats_in_any_case(client, value):
+    response = client.post('/api/v1/batches', data={'files': [(png(), 'a.png')], 'format': value},
+                           content_type='multipart/form-data')
+    assert response.status_code == 202
+    report = finished(client, response)
+    assert [item['format'] for item in report['items']] == [name.strip().upper() for name in value.split(',')]
+    assert all(item['status'] == 'done' for item in report['items']), report
+    for item in report['items']:
+        # Downloads resolve relative paths against the application folder, not this test's working directory
+        assert Image.open(Job.query.get(item['id']).result).format == item['format']
+
+
+def test_batch_rejects_unknown_format(client):
+    response = client.post('/api/v1/batches', data={'files': [(png(), 'a.png')], 'format': 'mp3'},
+                           content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert response.get_json()['items'] == ['a.png']
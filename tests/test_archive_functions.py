@@ -0,0 +1,151 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+from PIL import Image
+
+import archive_functions
+from archive_functions import ArchiveFuncs, ArchiveLimitError, ARCHIVE_LIMITS, ARCHIVE_CONTENT_FOLDER
+
+TEXT = b'hello archive\n' * 1000
+
+
+class Unseekable(object):
+    """Makes zipfile write data descriptors, as streaming zip writers do."""
+
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+
+def png():
+    buffer = io.BytesIO()
+    Image.new('RGB', (16, 16), 'red').save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def make_zip(path, members, descriptors=False):
+    with open(path, 'wb') as file:
+        with zipfile.ZipFile(Unseekable(file) if descriptors else file, 'w', zipfile.ZIP_DEFLATED) as arc:
+            for name, data in members:
+                arc.writestr(name, data)
+    return path
+
+
+def make_tar(path, members, mode='w:gz'):
+    with tarfile.open(path, mode) as arc:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                arc.addfile(info)
+            else:
+                info.size = len(data)
+                arc.addfile(info, io.BytesIO(data))
+    return path
+
+
+def convert(path, arc_format, formats=None):
+    arc = ArchiveFuncs(os.path.dirname(path), os.path.basename(path))
+    result = arc.convert_archive('converted', arc_format, formats or {}, max_workers=1)
+    assert isinstance(result, dict), result
+    return result
+
+
+def convert_error(path, arc_format, formats=None):
+    arc = ArchiveFuncs(os.path.dirname(path), os.path.basename(path))
+    result = arc.convert_archive('converted', arc_format, formats or {}, max_workers=1)
+    assert isinstance(result, tuple), result
+    return result[1]
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    for name in ('max_members', 'max_size', 'max_ratio', 'max_depth'):
+        monkeypatch.setattr(ARCHIVE_LIMITS, name, None)
+    return ARCHIVE_LIMITS
+
+
+@pytest.mark.parametrize('descriptors', [False, True])
+def test_zip_to_zip_copies_members(tmp_path, limits, descriptors):
+    source = make_zip(str(tmp_path / 'in.zip'), [('a.txt', TEXT), ('dir/b.txt', b'b')], descriptors)
+    with zipfile.ZipFile(source) as arc:
+        assert all(info.flag_bits & 0x08 for info in arc.infolist()) == descriptors
+    result = convert(source, 'zip')
+    with zipfile.ZipFile(result['path']) as arc:
+        assert arc.testzip() is None
+        assert arc.namelist() == ['a.txt', 'dir/b.txt']
+        assert arc.read('a.txt') == TEXT
+        assert not any(info.flag_bits & 0x08 for info in arc.infolist())
+    assert result['errors'] == {}
+
+
+def test_zip_to_tar(tmp_path, limits):
+    source = make_zip(str(tmp_path / 'in.zip'), [('dir/', b''), ('dir/a.txt', TEXT)], descriptors=True)
+    result = convert(source, 'gztar')
+    with tarfile.open(result['path']) as arc:
+        assert arc.getnames() == ['dir', 'dir/a.txt']
+        assert arc.getmember('dir').isdir()
+        assert arc.extractfile('dir/a.txt').read() == TEXT
+
+
+def test_tar_to_zip_normalises_dot_names(tmp_path, limits):
+    source = make_tar(str(tmp_path / 'in.tar.gz'), [('.', None), ('./dir', None), ('./dir/a.txt', TEXT),
+                                                     ('./b.png', png())])
+    result = convert(source, 'zip', {'b.png': 'BMP'})
+    with zipfile.ZipFile(result['path']) as arc:
+        assert arc.testzip() is None
+        assert sorted(arc.namelist()) == ['b.bmp', 'dir/', 'dir/a.txt']
+        assert arc.read('dir/a.txt') == TEXT
+        assert Image.open(io.BytesIO(arc.read('b.bmp'))).format == 'BMP'
+    assert result['errors'] == {}
+
+
+def test_member_count_limit(tmp_path, limits):
+    limits.max_members = 2
+    source = make_zip(str(tmp_path / 'in.zip'), [(name, b'x') for name in ('a', 'b', 'c')])
+    result = ArchiveFuncs(str(tmp_path), 'in.zip').list_files()
+    assert isinstance(result[1], ArchiveLimitError)
+    assert 'more than 2 files' in str(result[1])
+    assert isinstance(convert_error(source, 'zip'), ArchiveLimitError)
+
+
+def test_size_limit(tmp_path, limits):
+    limits.max_size = 1024 * 1024
+    make_tar(str(tmp_path / 'in.tar.gz'), [('big', b'\0' * (2 * 1024 * 1024))])
+    result = ArchiveFuncs(str(tmp_path), 'in.tar.gz').list_files()
+    assert isinstance(result[1], ArchiveLimitError)
+    assert 'more than 1 MB' in str(result[1])
+
+
+def test_ratio_limit(tmp_path, limits, monkeypatch):
+    monkeypatch.setattr(archive_functions, 'RATIO_CHECK_MIN_SIZE', 1024)
+    limits.max_ratio = 10
+    make_zip(str(tmp_path / 'in.zip'), [('zeros', b'\0' * (1024 * 1024))])
+    result = ArchiveFuncs(str(tmp_path), 'in.zip').extract_archive()
+    assert isinstance(result[1], ArchiveLimitError)
+    assert 'compressed more than 10 times' in str(result[1])
+
+
+def test_partial_extraction_is_removed(tmp_path, limits):
+    limits.max_members = 2
+    make_zip(str(tmp_path / 'in.zip'), [('a.txt', TEXT), ('b.txt', TEXT), ('c.txt', TEXT)])
+    result = ArchiveFuncs(str(tmp_path), 'in.zip').extract_archive()
+    assert isinstance(result[1], ArchiveLimitError)
+    assert not os.path.exists(str(tmp_path / ARCHIVE_CONTENT_FOLDER))
+
+
+def test_failed_conversion_removes_scratch_and_output(tmp_path, limits):
+    limits.max_members = 1
+    source = make_zip(str(tmp_path / 'in.zip'), [('a.png', png()), ('b.png', png())])
+    assert isinstance(convert_error(source, 'zip', {'a.png': 'BMP'}), ArchiveLimitError)
+    assert not os.path.exists(str(tmp_path / archive_functions.PIPELINE_FOLDER))
+    assert not os.path.exists(str(tmp_path / 'converted.zip'))
+
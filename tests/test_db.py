@@ -0,0 +1,34 @@
+import os
+import time
+from datetime import datetime, timedelta
+
+import db
+from db import Operation, Job, update_session, job_delete_inactive, to_db
+from storage import STORAGE
+
+
+def expired_operation(name, job=False):
+    # An operation whose last flushed heartbeat and folder are both older than the TTL
+    path = STORAGE.create(name)
+    update_session(Operation(user_operation_id=name, timestamp=datetime.utcnow() - timedelta(hours=4)))
+    if job:
+        update_session(Job(id=name, user_operation_id=name, kind='picture', path=path, filename='a.png',
+                           new_format='JPEG', status='done'))
+    stale = time.time() - 4 * 3600
+    os.utime(path, (stale, stale))
+    return path
+
+
+def test_buffered_heartbeat_keeps_the_folder(app, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    kept = expired_operation('a' * 32)
+    swept = expired_operation('b' * 32, job=True)
+    # A chunk arrives in another worker: its heartbeat is only in that worker's buffer
+    to_db('a' * 32)
+    db.pending_activity.clear()
+    job_delete_inactive()
+    assert os.path.isdir(kept)
+    assert Operation.query.filter_by(user_operation_id='a' * 32).count() == 1
+    assert not os.path.exists(swept)
+    assert Operation.query.filter_by(user_operation_id='b' * 32).count() == 0
+    assert Job.query.filter_by(user_operation_id='b' * 32).count() == 0
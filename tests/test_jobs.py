@@ -0,0 +1,119 @@
+import os
+import signal
+import socket
+import subprocess
+import time
+
+import pytest
+from PIL import Image
+
+import jobs
+from admission import AdmissionError
+from db import db, Job, update_session
+from jobs import JobQueue, JOB_DONE, JOB_ERROR, JOB_QUEUED
+
+
+def picture(folder, name='a.png'):
+    os.makedirs(str(folder), exist_ok=True)
+    Image.new('RGB', (8, 8), 'red').save(str(folder / name))
+    return str(folder), name
+
+
+def wait_for(queue, job_id, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with queue.app.app_context():
+            job = Job.query.get(job_id)
+            if job.status != JOB_QUEUED:
+                return job
+        time.sleep(0.05)
+    raise AssertionError('job {} is still queued'.format(job_id))
+
+
+def dead_pid():
+    process = subprocess.Popen(['true'])
+    process.wait()
+    return process.pid
+
+
+def killed(*args):
+    # What an OOM kill looks like from the pool
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def test_killed_worker_does_not_break_the_queue(app, tmp_path, monkeypatch):
+    queue = JobQueue(app)
+    run_conversion = jobs.run_conversion
+    monkeypatch.setattr(jobs, 'run_conversion', killed)
+    job_id = queue.enqueue('picture', *picture(tmp_path / 'one'), 'JPEG', 'op')
+    job = wait_for(queue, job_id)
+    assert job.status == JOB_ERROR
+    assert job.error.startswith('BrokenProcessPool')
+    monkeypatch.setattr(jobs, 'run_conversion', run_conversion)
+    job_id = queue.enqueue('picture', *picture(tmp_path / 'two'), 'JPEG', 'op')
+    assert wait_for(queue, job_id).status == JOB_DONE
+    assert queue.active('session:op') == 0
+
+
+class Refused(object):
+
+    def submit(self, *args, **kwargs):
+        raise RuntimeError('cannot schedule new futures after shutdown')
+
+
+def test_failed_submit_releases_the_slot(app, tmp_path):
+    queue = JobQueue(app)
+    pool, queue.executor = queue.executor, Refused()
+    with pytest.raises(RuntimeError):
+        queue.enqueue('picture', *picture(tmp_path / 'one'), 'JPEG', 'op')
+    assert queue.admission.held == {} and queue.running == {}
+    assert len(queue.pending) == 1
+    queue.executor = pool
+    job_id = queue.pending[0][0][0]
+    assert wait_for(queue, job_id).status == JOB_DONE
+
+
+def test_restart_with_the_same_pid_recovers_queued_jobs(app, tmp_path):
+    # Rows left by an earlier process that had this pid, before and after owners carried a boot id
+    previous = '{}:{}'.format(socket.gethostname(), os.getpid())
+    for job_id, owner, folder in (('old', previous, 'one'), ('boot', previous + ':earlier', 'two')):
+        path, filename = picture(tmp_path / folder)
+        update_session(Job(id=job_id, user_operation_id='op', kind='picture', path=path, filename=filename,
+                           new_format='JPEG', status=JOB_QUEUED, client='session:op', owner=owner))
+    queue = JobQueue(app)
+    assert wait_for(queue, 'old').status == JOB_DONE
+    assert wait_for(queue, 'boot').status == JOB_DONE
+
+
+def test_archive_conversions_count_against_the_quota(app, tmp_path):
+    queue = JobQueue(app)
+    queue.admission.session_limit = 1
+    with queue.reserve('archive', str(tmp_path), 'a.zip', 'zip', 'op', 'session:op', 1) as workers:
+        assert workers == 1
+        assert queue.active('session:op') == 1
+        with pytest.raises(AdmissionError) as refused:
+            queue.admit('session:op')
+        assert refused.value.status_code == 429
+    assert queue.active('session:op') == 0
+    assert Job.query.filter_by(kind='archive').one().status == JOB_DONE
+
+
+def test_archive_conversion_of_a_dead_process_is_not_resubmitted(app, tmp_path):
+    update_session(Job(id='arc', user_operation_id='op', kind='archive', path=str(tmp_path), filename='a.zip',
+                       new_format='zip', status=JOB_QUEUED, client='session:op', owner='elsewhere:1'))
+    queue = JobQueue(app)
+    # Another host's process is presumed alive, a pid on this host that no longer exists is not
+    assert Job.query.get('arc').status == JOB_QUEUED
+    Job.query.filter_by(id='arc').update({'owner': '{}:{}:boot'.format(socket.gethostname(), dead_pid())})
+    db.session.commit()
+    queue.recover()
+    assert Job.query.get('arc').status == JOB_ERROR
+    assert queue.active('session:op') == 0
+
+
+def test_picture_formats_are_timed_separately(app, tmp_path):
+    started = time.monotonic()
+    results = jobs.run_conversion('picture', *picture(tmp_path), ['JPEG', 'WEBP', 'BMP'])
+    total = time.monotonic() - started
+    assert [os.path.splitext(result['new_file_path'])[1] for result in results] == ['.jpeg', '.webp', '.bmp']
+    assert sum(result['elapsed'] for result in results) <= total
@@ -0,0 +1,78 @@
+import hashlib
+import os
+import shutil
+import uuid
+
+from flask import Request, current_app
+from flask_login import current_user
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from storage import STORAGE
+
+
+def upload_limit():
+    if current_user.is_authenticated:
+        return current_app.config['MAX_CONTENT_LENGTH_FOR_AUTH']
+    return current_app.config['MAX_CONTENT_LENGTH_FOR_UNAUTH']
+
+
+def upload_digest(file_data):
+    stream = getattr(file_data, 'stream', None)
+    return stream.hexdigest() if isinstance(stream, UploadStream) else None
+
+
+class UploadStream(object):
+    """Spools an uploaded file to disk while it is being parsed, hashing and size-checking every chunk."""
+
+    def __init__(self, directory, limit=None):
+        self.path = os.path.join(directory, uuid.uuid4().hex)
+        self.file = open(self.path, 'w+b')
+        self.limit = limit
+        self.size = 0
+        self.hash = hashlib.sha256()
+        self.committed = False
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.limit is not None and self.size > self.limit:
+            raise RequestEntityTooLarge()
+        self.hash.update(data)
+        return self.file.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def commit(self, destination):
+        self.file.close()
+        try:
+            os.replace(self.path, destination)
+        except OSError:
+            # The spool sits on the scratch tier, which may be a different filesystem
+            shutil.move(self.path, destination)
+        self.committed = True
+
+    def close(self):
+        self.file.close()
+        if not self.committed and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class StreamingRequest(Request):
+
+    @property
+    def max_content_length(self):
+        return upload_limit()
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = UploadStream(STORAGE.spool_directory(), upload_limit())
+        # A body that fails to parse never puts its stream into request.files, so close() tracks them all
+        self.__dict__.setdefault('spooled', list()).append(stream)
+        return stream
+
+    def close(self):
+        for stream in self.__dict__.get('spooled', ()):
+            stream.close()
+        super(StreamingRequest, self).close()